@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Playlist, Song
+from .models import Playlist, Song, PlaylistStats
 
 admin.site.register(Playlist)
-admin.site.register(Song)
\ No newline at end of file
+admin.site.register(Song)
+admin.site.register(PlaylistStats)
\ No newline at end of file
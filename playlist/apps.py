@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class PlaylistConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'playlist'
+
+    def ready(self):
+        # Registers the signal receivers
+        import playlist.stats
+        import playlist.search
+        import playlist.changes
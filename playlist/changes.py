@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from playlist.models import Playlist, Song, PlaylistChange
+from playlist.signals import songs_bulk_added, play_counts_flushed
+
+
+# Versions of a playlist whose changes are kept, clients that are further behind resync
+CHANGE_LOG_VERSIONS = 1000
+
+
+def record_changes(playlist_id, kind, song_ids):
+  """
+    Bumps the version of the playlist and logs the changed songs under the new version
+  """
+  with transaction.atomic():
+    # Locks the playlist, so concurrent changes get consecutive versions
+    version = Playlist.objects.select_for_update().values_list('version', flat=True).filter(id=playlist_id).first()
+
+    if version is None:
+      return None
+
+    version += 1
+
+    Playlist.objects.filter(id=playlist_id).update(version=version)
+    PlaylistChange.objects.bulk_create([
+      PlaylistChange(playlist_id=playlist_id, version=version, song_id=song_id, kind=kind)
+      for song_id in song_ids
+    ])
+    PlaylistChange.objects.filter(playlist_id=playlist_id, version__lte=version - CHANGE_LOG_VERSIONS).delete()
+
+  return version
+
+
+def changes_since(playlist_id, since_version):
+  """
+    Returns the current version and the song ids that were added, removed and updated
+    after `since_version`, or None for the changes when the log does not go back that far
+  """
+  version = Playlist.objects.values_list('version', flat=True).get(id=playlist_id)
+
+  if since_version < version - CHANGE_LOG_VERSIONS or since_version > version:
+    return version, None
+
+  # The last change of a song wins, but a song added and then updated is still new to the client
+  kinds = {}
+  for song_id, kind in PlaylistChange.objects.filter(playlist_id=playlist_id, version__gt=since_version).order_by('version').values_list('song_id', 'kind'):
+    if kind == PlaylistChange.Kind.UPDATED and kinds.get(song_id) == PlaylistChange.Kind.ADDED:
+      continue
+
+    kinds[song_id] = kind
+
+  changes = {kind: [] for kind in PlaylistChange.Kind.values}
+  for song_id, kind in kinds.items():
+    changes[kind].append(song_id)
+
+  return version, changes
+
+
+@receiver(post_save, sender=Song)
+def song_saved(sender, instance, created, **kwargs):
+  record_changes(instance.playlist_id, PlaylistChange.Kind.ADDED if created else PlaylistChange.Kind.UPDATED, [instance.id])
+
+
+@receiver(post_delete, sender=Song)
+def song_deleted(sender, instance, origin=None, **kwargs):
+  # The songs of a deleted playlist go with it, there is nothing left to sync
+  if isinstance(origin, Playlist):
+    return
+
+  record_changes(instance.playlist_id, PlaylistChange.Kind.REMOVED, [instance.id])
+
+
+@receiver(songs_bulk_added)
+def songs_imported(sender, playlist_id, song_ids, **kwargs):
+  if len(song_ids) > 0:
+    record_changes(playlist_id, PlaylistChange.Kind.ADDED, song_ids)
+
+
+@receiver(play_counts_flushed)
+def songs_played(sender, songs_by_playlist, **kwargs):
+  for playlist_id, song_ids in songs_by_playlist.items():
+    record_changes(playlist_id, PlaylistChange.Kind.UPDATED, song_ids)
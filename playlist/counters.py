@@ -0,0 +1,150 @@
+import datetime
+import uuid
+from collections import defaultdict
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from playlist.signals import play_counts_flushed
+
+redis = get_redis_connection('default')
+
+
+# song id -> plays that are not in Song.play_count yet
+PLAY_COUNTS_KEY = 'playlist::play_counts'
+
+# The deltas that are being written to the database right now
+FLUSHING_KEY = 'playlist::play_counts::flushing'
+
+# Identifies the deltas in FLUSHING_KEY, the database remembers which flushes it applied
+FLUSH_ID_KEY = 'playlist::play_counts::flush_id'
+
+# Held while flushing, so two flushers never apply the same deltas
+FLUSH_LOCK_KEY = 'playlist::play_counts::flush_lock'
+FLUSH_LOCK_TTL = 60 * 5
+
+# Applied flushes are remembered this long, far longer than a failed flush waits for its retry
+FLUSH_LOG_AGE = datetime.timedelta(days=1)
+
+
+def increment_play_count(song_id, amount=1):
+  redis.hincrby(PLAY_COUNTS_KEY, song_id, amount)
+
+
+def pending_play_counts(song_ids):
+  """
+    Returns the plays per song that are not flushed to the database yet, in one round trip
+  """
+  song_ids = list(song_ids)
+
+  if len(song_ids) == 0:
+    return {}
+
+  pipeline = redis.pipeline(transaction=False)
+  pipeline.hmget(PLAY_COUNTS_KEY, song_ids)
+  pipeline.hmget(FLUSHING_KEY, song_ids)
+  pending, flushing = pipeline.execute()
+
+  return {
+    id: int(a or 0) + int(b or 0) for id, a, b in zip(song_ids, pending, flushing)
+  }
+
+
+def annotate_play_counts(songs):
+  """
+    Sets `pending_play_count` on every song, so Song.toJSON does not have to ask Redis per song.
+    Songs that already have it are skipped
+  """
+  songs = list(songs)
+  missing = [song for song in songs if getattr(song, 'pending_play_count', None) is None]
+  pending = pending_play_counts([song.id for song in missing])
+
+  for song in missing:
+    song.pending_play_count = pending[song.id]
+
+  return songs
+
+
+def release_lock(key, token):
+  """
+    Deletes a lock only if it is still ours, it may have expired and been taken by another flusher
+  """
+  with redis.pipeline() as pipeline:
+    try:
+      pipeline.watch(key)
+
+      if pipeline.get(key) == token:
+        pipeline.multi()
+        pipeline.delete(key)
+        pipeline.execute()
+    except WatchError:
+      pass
+
+
+def flush_play_counts():
+  """
+    Writes the buffered plays to Song.play_count. The buffer is renamed first, so plays
+    that come in during the flush end up in the next one. Songs are updated with one
+    F() expression UPDATE per distinct delta. A flush that failed is retried first.
+
+    Only one flusher runs at a time (a lock in Redis). Every flush has an id that is stored
+    in the same transaction as the updates, so a flush that crashed after its commit but
+    before clearing the buffer is not applied a second time
+  """
+  Song = apps.get_model('playlist', 'Song')
+  PlayCountFlush = apps.get_model('playlist', 'PlayCountFlush')
+
+  token = uuid.uuid4().hex.encode()
+
+  if not redis.set(FLUSH_LOCK_KEY, token, nx=True, ex=FLUSH_LOCK_TTL):
+    return 0, 0
+
+  try:
+    if not redis.exists(FLUSHING_KEY):
+      if not redis.exists(PLAY_COUNTS_KEY):
+        return 0, 0
+
+      pipeline = redis.pipeline(transaction=True)
+      pipeline.rename(PLAY_COUNTS_KEY, FLUSHING_KEY)
+      pipeline.set(FLUSH_ID_KEY, uuid.uuid4().hex)
+      pipeline.execute()
+
+    flush_id = redis.get(FLUSH_ID_KEY)
+
+    if flush_id is None:
+      # Left behind by a version that did not identify its flushes
+      flush_id = uuid.uuid4().hex.encode()
+      redis.set(FLUSH_ID_KEY, flush_id)
+
+    flush_id = flush_id.decode()
+
+    by_delta = defaultdict(list)
+    for song_id, delta in redis.hgetall(FLUSHING_KEY).items():
+      if int(delta) != 0:
+        by_delta[int(delta)].append(int(song_id))
+
+    song_ids = [id for ids in by_delta.values() for id in ids]
+
+    with transaction.atomic():
+      if not PlayCountFlush.objects.filter(flush_id=flush_id).exists():
+        for delta, ids in by_delta.items():
+          Song.objects.filter(id__in=ids).update(play_count=F('play_count') + delta)
+
+        PlayCountFlush.objects.create(flush_id=flush_id)
+        PlayCountFlush.objects.filter(flushed_at__lt=timezone.now() - FLUSH_LOG_AGE).delete()
+
+      songs_by_playlist = defaultdict(list)
+      for song_id, playlist_id in Song.objects.filter(id__in=song_ids).values_list('id', 'playlist_id'):
+        songs_by_playlist[playlist_id].append(song_id)
+
+    redis.delete(FLUSHING_KEY, FLUSH_ID_KEY)
+  finally:
+    release_lock(FLUSH_LOCK_KEY, token)
+
+  play_counts_flushed.send(sender=Song, playlist_ids=list(songs_by_playlist), songs_by_playlist=dict(songs_by_playlist))
+
+  return len(song_ids), sum(delta * len(ids) for delta, ids in by_delta.items())
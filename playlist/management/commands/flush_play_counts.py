@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from playlist.counters import flush_play_counts
+
+
+class Command(BaseCommand):
+  help = 'Writes the play counts buffered in Redis to the database'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--interval', type=float, default=None, help='Keep flushing every this many seconds instead of flushing once')
+
+  def handle(self, *args, **options):
+    interval = options['interval']
+
+    while True:
+      songs, plays = flush_play_counts()
+
+      if songs > 0 or interval is None:
+        self.stdout.write(f'Flushed {plays} plays of {songs} songs')
+
+      if interval is None:
+        break
+
+      time.sleep(interval)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from playlist.models import Playlist
+from playlist.search import build_index, delete_index
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds the song search index of all playlists, or of the given ones'
+
+  def add_arguments(self, parser):
+    parser.add_argument('playlist_ids', nargs='*', type=int)
+
+  def handle(self, *args, **options):
+    playlist_ids = options['playlist_ids'] or Playlist.objects.values_list('id', flat=True)
+
+    for playlist_id in playlist_ids:
+      delete_index(playlist_id)
+      build_index(playlist_id)
+
+    self.stdout.write(f'Rebuilt the search index of {len(playlist_ids)} playlists')
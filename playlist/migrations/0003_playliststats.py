@@ -0,0 +1,49 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:52
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def compute_stats(apps, schema_editor):
+    Playlist = apps.get_model('playlist', 'Playlist')
+    Song = apps.get_model('playlist', 'Song')
+    PlaylistStats = apps.get_model('playlist', 'PlaylistStats')
+
+    stats = {
+        row['playlist']: row for row in Song.objects.values('playlist').annotate(
+            song_count=Count('id'),
+            contributor_count=Count('added_by', distinct=True),
+            total_length=Sum('length'),
+        )
+    }
+
+    PlaylistStats.objects.bulk_create([
+        PlaylistStats(
+            playlist_id=playlist_id,
+            song_count=stats.get(playlist_id, {}).get('song_count', 0),
+            contributor_count=stats.get(playlist_id, {}).get('contributor_count', 0),
+            total_length=stats.get(playlist_id, {}).get('total_length') or 0,
+        )
+        for playlist_id in Playlist.objects.values_list('id', flat=True)
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlist', '0002_song_play_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaylistStats',
+            fields=[
+                ('playlist', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='playlist.playlist')),
+                ('song_count', models.IntegerField(default=0)),
+                ('contributor_count', models.IntegerField(default=0)),
+                ('total_length', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(compute_stats, migrations.RunPython.noop),
+    ]
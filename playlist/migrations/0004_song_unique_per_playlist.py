@@ -0,0 +1,41 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:53
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def delete_duplicate_songs(apps, schema_editor):
+    Song = apps.get_model('playlist', 'Song')
+    PlaylistStats = apps.get_model('playlist', 'PlaylistStats')
+
+    # Keep the first song of every (playlist, platform_id) pair
+    duplicates = Song.objects.values('playlist', 'platform_id').annotate(count=Count('id'), keep=Min('id')).filter(count__gt=1)
+    playlist_ids = set()
+
+    for duplicate in duplicates:
+        Song.objects.filter(playlist=duplicate['playlist'], platform_id=duplicate['platform_id']).exclude(id=duplicate['keep']).delete()
+        playlist_ids.add(duplicate['playlist'])
+
+    for playlist_id in playlist_ids:
+        stats = Song.objects.filter(playlist_id=playlist_id).aggregate(
+            song_count=Count('id'),
+            contributor_count=Count('added_by', distinct=True),
+            total_length=Sum('length'),
+        )
+        stats['total_length'] = stats['total_length'] or 0
+        PlaylistStats.objects.update_or_create(playlist_id=playlist_id, defaults=stats)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlist', '0003_playliststats'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_songs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='song',
+            constraint=models.UniqueConstraint(fields=('playlist', 'platform_id'), name='unique_song_per_playlist'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlist', '0004_song_unique_per_playlist'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playlist',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='PlaylistChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField()),
+                ('song_id', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('added', 'Added'), ('removed', 'Removed'), ('updated', 'Updated')], max_length=10)),
+                ('playlist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='playlist.playlist')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='playlistchange',
+            index=models.Index(fields=['playlist', 'version'], name='playlist_pl_playlis_14d189_idx'),
+        ),
+    ]
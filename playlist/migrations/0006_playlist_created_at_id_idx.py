@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlist', '0005_playlist_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='playlist',
+            index=models.Index(fields=['-created_at', '-id'], name='playlist_created_at_id_idx'),
+        ),
+    ]
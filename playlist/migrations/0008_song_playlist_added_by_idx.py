@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 09:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlist', '0007_playcountflush'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['playlist', 'added_by'], name='song_playlist_added_by_idx'),
+        ),
+    ]
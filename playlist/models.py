@@ -1,6 +1,10 @@
 from django.db import models
 from user.models import User
 
+from tawa3.serializers import register
+
+from playlist.counters import pending_play_counts, annotate_play_counts
+
 
 class Playlist(models.Model):
   name = models.CharField(max_length=100)
@@ -9,6 +13,9 @@ class Playlist(models.Model):
   updated_at = models.DateTimeField(auto_now=True)
   creator = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, default=None)
 
+  # Bumped whenever songs are added, deleted or updated, see playlist.changes
+  version = models.BigIntegerField(default=0)
+
   def __str__(self):
     return f'Playlist: {self.name}'
 
@@ -19,12 +26,17 @@ class Playlist(models.Model):
       'description': self.description,
       'created_at': self.created_at,
       'updated_at': self.updated_at,
+      'version': self.version,
       'creator': self.creator.toJSON() if recursive else self.creator.username,
-      'songs': [song.toJSON() for song in self.songs.all()] if recursive else None
+      'songs': [song.toJSON() for song in annotate_play_counts(self.songs.all())] if recursive else None
     }
 
   class Meta:
     ordering = ['-created_at']
+    indexes = [
+      # Keyset pagination, see playlist.pagination
+      models.Index(fields=['-created_at', '-id'], name='playlist_created_at_id_idx'),
+    ]
     verbose_name = 'Playlist'
     verbose_name_plural = 'Playlists'
 
@@ -57,10 +69,31 @@ class Song(models.Model):
 
   song_type = models.CharField(max_length=20, choices=SongType.choices, default=SongType.SPOTIFY)
 
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['playlist', 'platform_id'], name='unique_song_per_playlist'),
+    ]
+    indexes = [
+      # Counting the contributors of a playlist, see playlist.stats
+      models.Index(fields=['playlist', 'added_by'], name='song_playlist_added_by_idx'),
+    ]
+
   def __str__(self):
     return f'{self.title} by {self.artists}'
 
 
+  @property
+  def current_play_count(self):
+    """
+      The play count including the plays that are still buffered in Redis
+    """
+    pending = getattr(self, 'pending_play_count', None)
+
+    if pending is None:
+      pending = pending_play_counts([self.id])[self.id]
+
+    return self.play_count + pending
+
   def toJSON(self, recursive=True):
     return {
       'id': self.id,
@@ -72,5 +105,102 @@ class Song(models.Model):
       'added_by': self.added_by.toJSON() if recursive else self.added_by.username,
       'song_type': self.song_type,
       'platform_id': self.platform_id,
-      'play_count': self.play_count,
-    }
\ No newline at end of file
+      'play_count': self.current_play_count,
+    }
+
+
+class PlaylistStats(models.Model):
+  """
+    Counters for the lobby screen, kept up to date when songs are added or deleted
+    (see playlist.stats) so they do not have to be computed from the songs
+  """
+  playlist = models.OneToOneField(Playlist, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+  song_count = models.IntegerField(default=0)
+  contributor_count = models.IntegerField(default=0)
+  total_length = models.BigIntegerField(default=0)
+
+  def toJSON(self, recursive=True):
+    return {
+      'playlist_id': self.playlist_id,
+      'song_count': self.song_count,
+      'contributor_count': self.contributor_count,
+      'total_length': self.total_length
+    }
+
+  def __str__(self):
+    return f'Stats for playlist: {self.playlist_id}'
+
+
+class PlaylistChange(models.Model):
+  """
+    What happened to a song in a version of a playlist, so clients can sync the
+    difference to the version they have. Old changes are pruned
+  """
+  class Kind(models.TextChoices):
+    ADDED = 'added', 'Added'
+    REMOVED = 'removed', 'Removed'
+    UPDATED = 'updated', 'Updated'
+
+  playlist = models.ForeignKey(Playlist, on_delete=models.CASCADE, related_name='changes')
+  version = models.BigIntegerField()
+  # Not a foreign key, removed songs are gone
+  song_id = models.BigIntegerField()
+  kind = models.CharField(max_length=10, choices=Kind.choices)
+
+  class Meta:
+    indexes = [
+      models.Index(fields=['playlist', 'version']),
+    ]
+
+  def __str__(self):
+    return f'Song {self.song_id} {self.kind} in version {self.version} of playlist: {self.playlist_id}'
+
+
+class PlayCountFlush(models.Model):
+  """
+    A flush of the play counts buffered in Redis that was written to the database,
+    see playlist.counters.flush_play_counts
+  """
+  flush_id = models.CharField(max_length=32, unique=True)
+  flushed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+  def __str__(self):
+    return f'Play count flush: {self.flush_id}'
+
+
+def prepare_playlists(playlists, recursive):
+  if recursive:
+    annotate_play_counts(song for playlist in playlists for song in playlist.songs.all())
+
+
+def prepare_songs(songs, recursive):
+  annotate_play_counts(songs)
+
+
+register(Playlist,
+  select_related=['creator'],
+  prefetch_related=[models.Prefetch('songs', queryset=Song.objects.select_related('added_by'))],
+  small_select_related=['creator'],
+  prepare=prepare_playlists,
+  columns={
+    'id': 'id',
+    'name': 'name',
+    'description': 'description',
+    'created_at': 'created_at',
+    'updated_at': 'updated_at',
+    'version': 'version',
+  })
+register(Song,
+  select_related=['added_by'],
+  small_select_related=['added_by'],
+  prepare=prepare_songs,
+  columns={
+    'id': 'id',
+    'title': 'title',
+    'artists': 'artists',
+    'album': 'album',
+    'length': 'length',
+    'cover': 'cover',
+    'song_type': 'song_type',
+    'platform_id': 'platform_id',
+  })
@@ -0,0 +1,41 @@
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+
+from django.db.models import Q
+
+
+# Playlists are listed newest first, the id breaks ties between playlists created at the same time
+ORDERING = ['-created_at', '-id']
+
+
+def encode_cursor(created_at, id):
+  return urlsafe_b64encode(f'{created_at.isoformat()}|{id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+  try:
+    created_at, id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(id)
+  except (ValueError, UnicodeDecodeError, binascii.Error):
+    raise Exception('Invalid cursor')
+
+
+def keyset_page(queryset, cursor, limit):
+  """
+    Returns the ids of the next `limit` rows of a queryset after `cursor` (None for the
+    first page) and the cursor of the page after them, None on the last page. The rows
+    are found with a range scan on the (created_at, id) index, however deep the page is
+  """
+  queryset = queryset.order_by(*ORDERING)
+
+  if cursor is not None:
+    created_at, id = decode_cursor(cursor)
+    queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=id))
+
+  keys = list(queryset.values_list('created_at', 'id')[:limit + 1])
+
+  if len(keys) > limit:
+    return [id for _, id in keys[:limit]], encode_cursor(*keys[limit - 1])
+
+  return [id for _, id in keys], None
@@ -0,0 +1,250 @@
+import re
+import unicodedata
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from playlist.models import Playlist, Song
+from playlist.signals import songs_bulk_added
+
+redis = get_redis_connection('default')
+
+
+# Longer query words are matched on their first characters and checked against the songs
+MAX_PREFIX_LENGTH = 20
+
+SEARCH_FIELDS = ['title', 'artists', 'album']
+
+# Stored in the ready key, indexes of an older version are built again
+INDEX_VERSION = b'2'
+
+
+def prefix_key(playlist_id, prefix):
+  return f'playlist::{playlist_id}::search::{prefix}'
+
+
+def tokens_key(playlist_id):
+  return f'playlist::{playlist_id}::search_tokens'
+
+
+def title_prefix_key(playlist_id, prefix):
+  return f'playlist::{playlist_id}::search_title::{prefix}'
+
+
+def titles_key(playlist_id):
+  return f'playlist::{playlist_id}::search_titles'
+
+
+def ready_key(playlist_id):
+  return f'playlist::{playlist_id}::search_ready'
+
+
+def tokenize(text):
+  """
+    Splits text into lowercase words without accents, so "Beyoncé" matches "beyonce"
+  """
+  text = unicodedata.normalize('NFKD', text or '')
+  text = ''.join(c for c in text if not unicodedata.combining(c))
+
+  return re.findall(r'\w+', text.lower())
+
+
+def song_tokens(title, artists, album):
+  return set(tokenize(title) + tokenize(artists) + tokenize(album))
+
+
+def song_title(title):
+  return ' '.join(tokenize(title))
+
+
+def prefixes(tokens):
+  return set(token[:length] for token in tokens for length in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1))
+
+
+def queue_index_song(pipeline, playlist_id, song_id, tokens, title, old_tokens=(), old_title=''):
+  """
+    Queues the commands that point the prefixes of `tokens` and of the whole `title` to
+    the song, and drop the prefixes of `old_tokens` and `old_title` the song does not have anymore
+  """
+  new, old = prefixes(tokens), prefixes(old_tokens)
+
+  for prefix in old - new:
+    pipeline.srem(prefix_key(playlist_id, prefix), song_id)
+
+  for prefix in new - old:
+    pipeline.sadd(prefix_key(playlist_id, prefix), song_id)
+
+  new, old = prefixes([title] if title else []), prefixes([old_title] if old_title else [])
+
+  for prefix in old - new:
+    pipeline.srem(title_prefix_key(playlist_id, prefix), song_id)
+
+  for prefix in new - old:
+    pipeline.sadd(title_prefix_key(playlist_id, prefix), song_id)
+
+  pipeline.hset(tokens_key(playlist_id), song_id, ' '.join(sorted(tokens)))
+  pipeline.hset(titles_key(playlist_id), song_id, title)
+
+
+def index_songs(playlist_id, songs):
+  """
+    Adds or updates `songs`, (id, title, artists, album) tuples, in the index of the playlist
+  """
+  songs = list(songs)
+
+  if len(songs) == 0:
+    return
+
+  pipeline = redis.pipeline(transaction=False)
+  pipeline.hmget(tokens_key(playlist_id), [song[0] for song in songs])
+  pipeline.hmget(titles_key(playlist_id), [song[0] for song in songs])
+  stored_tokens, stored_titles = pipeline.execute()
+
+  pipeline = redis.pipeline(transaction=False)
+
+  for (song_id, title, artists, album), old, old_title in zip(songs, stored_tokens, stored_titles):
+    old_tokens = old.decode().split() if old else []
+    old_title = old_title.decode() if old_title else ''
+    queue_index_song(pipeline, playlist_id, song_id, song_tokens(title, artists, album), song_title(title), old_tokens, old_title)
+
+  pipeline.execute()
+
+
+def unindex_song(playlist_id, song_id):
+  pipeline = redis.pipeline(transaction=False)
+  pipeline.hget(tokens_key(playlist_id), song_id)
+  pipeline.hget(titles_key(playlist_id), song_id)
+  stored, title = pipeline.execute()
+
+  pipeline = redis.pipeline(transaction=False)
+
+  for prefix in prefixes(stored.decode().split() if stored else []):
+    pipeline.srem(prefix_key(playlist_id, prefix), song_id)
+
+  for prefix in prefixes([title.decode()] if title else []):
+    pipeline.srem(title_prefix_key(playlist_id, prefix), song_id)
+
+  pipeline.hdel(tokens_key(playlist_id), song_id)
+  pipeline.hdel(titles_key(playlist_id), song_id)
+  pipeline.execute()
+
+
+def build_index(playlist_id):
+  """
+    Indexes all songs of the playlist. Songs that are added or deleted meanwhile are
+    indexed by the signal receivers, a deleted song left behind is dropped when searching
+  """
+  index_songs(playlist_id, Song.objects.filter(playlist_id=playlist_id).values_list('id', *SEARCH_FIELDS).iterator())
+  redis.set(ready_key(playlist_id), INDEX_VERSION)
+
+
+def delete_index(playlist_id):
+  pipeline = redis.pipeline(transaction=False)
+  pipeline.hvals(tokens_key(playlist_id))
+  pipeline.hvals(titles_key(playlist_id))
+  stored, titles = pipeline.execute()
+
+  keys = set(prefix_key(playlist_id, prefix) for tokens in stored for prefix in prefixes(tokens.decode().split()))
+  keys |= set(title_prefix_key(playlist_id, prefix) for title in titles for prefix in prefixes([title.decode()]))
+
+  redis.delete(tokens_key(playlist_id), titles_key(playlist_id), ready_key(playlist_id), *keys)
+
+
+def ensure_indexes(playlist_ids):
+  """
+    Builds the indexes of playlists that were never searched (or were indexed by an older
+    version), in one round trip when they all exist
+  """
+  pipeline = redis.pipeline(transaction=False)
+
+  for playlist_id in playlist_ids:
+    pipeline.get(ready_key(playlist_id))
+
+  for playlist_id, version in zip(playlist_ids, pipeline.execute()):
+    if version != INDEX_VERSION:
+      build_index(playlist_id)
+
+
+def search(playlist_ids, query, limit):
+  """
+    Returns up to `limit` songs of the playlists whose title, artists or album contain
+    a word starting with every word of the query. Titles starting with the query come first
+  """
+  words = tokenize(query)
+
+  if len(words) == 0 or len(playlist_ids) == 0:
+    return []
+
+  ensure_indexes(playlist_ids)
+
+  keys = set(prefix_key('{}', word[:MAX_PREFIX_LENGTH]) for word in words)
+  title = ' '.join(words)
+
+  pipeline = redis.pipeline(transaction=False)
+
+  for playlist_id in playlist_ids:
+    word_keys = [key.format(playlist_id) for key in keys]
+    pipeline.sinter(word_keys + [title_prefix_key(playlist_id, title[:MAX_PREFIX_LENGTH])])
+    pipeline.sinter(word_keys)
+
+  replies = pipeline.execute()
+
+  # Every candidate is ranked before any is dropped, the songs whose title starts with the query first
+  title_ids = set(int(id) for ids in replies[0::2] for id in ids)
+  other_ids = set(int(id) for ids in replies[1::2] for id in ids) - title_ids
+  song_ids = sorted(title_ids) + sorted(other_ids)
+
+  results = []
+
+  # Words longer than the indexed prefixes, or ids of songs deleted while the index was built,
+  # are dropped here, the candidates are loaded in batches until there are enough songs
+  for start in range(0, len(song_ids), limit * 2):
+    batch = song_ids[start:start + limit * 2]
+    songs = Song.objects.select_related('added_by').in_bulk(batch)
+
+    for song_id in batch:
+      song = songs.get(song_id)
+
+      if song is None:
+        continue
+
+      tokens = song_tokens(song.title, song.artists, song.album)
+
+      if all(any(token.startswith(word) for token in tokens) for word in words):
+        results.append(song)
+
+      if len(results) == limit:
+        break
+
+    if len(results) == limit:
+      break
+
+  # The title index only holds the first characters of the titles
+  results.sort(key=lambda song: not song_title(song.title).startswith(title))
+
+  return results
+
+
+@receiver(post_save, sender=Song)
+def song_saved(sender, instance, **kwargs):
+  index_songs(instance.playlist_id, [(instance.id, instance.title, instance.artists, instance.album)])
+
+
+@receiver(post_delete, sender=Song)
+def song_deleted(sender, instance, origin=None, **kwargs):
+  # playlist_deleted drops the whole index
+  if isinstance(origin, Playlist):
+    return
+
+  unindex_song(instance.playlist_id, instance.id)
+
+
+@receiver(songs_bulk_added)
+def songs_imported(sender, playlist_id, song_ids, **kwargs):
+  index_songs(playlist_id, Song.objects.filter(id__in=song_ids).values_list('id', *SEARCH_FIELDS))
+
+
+@receiver(post_delete, sender=Playlist)
+def playlist_deleted(sender, instance, **kwargs):
+  delete_index(instance.id)
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+
+# Sent after buffered play counts were written to the database, with the ids of the
+# playlists whose songs changed and their changed song ids. Queryset updates do not send post_save
+play_counts_flushed = Signal()
+
+# Sent after songs were added with bulk_create, which does not send post_save
+songs_bulk_added = Signal()
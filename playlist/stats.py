@@ -0,0 +1,83 @@
+from django.db.models import F, Count, Sum, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from playlist.models import Playlist, Song, PlaylistStats
+
+
+def compute_stats(playlist_id):
+  """
+    Computes the stats of a playlist from its songs with aggregate queries
+  """
+  stats = Song.objects.filter(playlist_id=playlist_id).aggregate(
+    song_count=Count('id'),
+    contributor_count=Count('added_by', distinct=True),
+    total_length=Sum('length'),
+  )
+  stats['total_length'] = stats['total_length'] or 0
+
+  PlaylistStats.objects.update_or_create(playlist_id=playlist_id, defaults=stats)
+
+
+def get_stats(playlist_id):
+  stats = PlaylistStats.objects.filter(playlist_id=playlist_id).first()
+
+  if stats is None:
+    if not Playlist.objects.filter(id=playlist_id).exists():
+      raise Exception("Playlist not found")
+
+    compute_stats(playlist_id)
+    stats = PlaylistStats.objects.get(playlist_id=playlist_id)
+
+  return stats
+
+
+def contributor_count(playlist_id):
+  """
+    The number of contributors as a subquery, evaluated by the UPDATE itself so songs that
+    are added or deleted concurrently by the same user cannot be counted twice or not at all
+  """
+  return Subquery(
+    Song.objects.filter(playlist_id=playlist_id, added_by__isnull=False)
+      .values('playlist_id')
+      .annotate(count=Count('added_by', distinct=True))
+      .values('count')
+  )
+
+
+def update_stats(playlist_id, songs, sign):
+  PlaylistStats.objects.filter(playlist_id=playlist_id).update(
+    song_count=F('song_count') + sign * len(songs),
+    contributor_count=Coalesce(contributor_count(playlist_id), 0),
+    total_length=F('total_length') + sign * sum(song.length for song in songs),
+  )
+
+
+def songs_added(playlist_id, songs):
+  update_stats(playlist_id, songs, 1)
+
+
+def songs_removed(playlist_id, songs):
+  update_stats(playlist_id, songs, -1)
+
+
+@receiver(post_save, sender=Playlist)
+def create_stats(sender, instance, created, **kwargs):
+  if created:
+    PlaylistStats.objects.get_or_create(playlist=instance)
+
+
+@receiver(post_save, sender=Song)
+def song_added(sender, instance, created, **kwargs):
+  if created:
+    songs_added(instance.playlist_id, [instance])
+
+
+@receiver(post_delete, sender=Song)
+def song_removed(sender, instance, origin=None, **kwargs):
+  # The stats are deleted with the playlist
+  if isinstance(origin, Playlist):
+    return
+
+  songs_removed(instance.playlist_id, [instance])
@@ -0,0 +1,7 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+  path('export/', views.export_playlists, name='export_playlists'),
+]
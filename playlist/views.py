@@ -1,6 +1,21 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction, IntegrityError
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+
 from playlist.models import Playlist, Song
+from playlist.stats import get_stats, compute_stats
+from playlist.search import search
+from playlist.changes import changes_since
+from playlist.pagination import ORDERING, keyset_page
+from playlist.signals import songs_bulk_added
+from user.models import User
+from playlist.counters import increment_play_count as increment_play_counter, annotate_play_counts
 
 from tawa3.tools import is_authenticated, J, JS
+from tawa3.serializers import optimized
 
 from modernrpc.core import rpc_method
 from modernrpc.auth import set_authentication_predicate
@@ -8,14 +23,129 @@ from modernrpc.auth import set_authentication_predicate
 
 @rpc_method
 @set_authentication_predicate(is_authenticated)
-def get_playlists():
-  return [JS(x) for x in Playlist.objects.all()]
+def get_playlists(fields=None):
+  """
+    Returns all playlists, `fields` limits the keys (and columns) of every playlist
+  """
+  return JS(Playlist.objects.all(), fields=fields)
+
+
+# Playlists per get_playlists_page call
+MAX_PAGE_SIZE = 100
+
+# Playlists per query of export_playlists
+EXPORT_PAGE_SIZE = 500
+
+
+def playlists_by_id(ids, fields=None):
+  return JS(Playlist.objects.filter(id__in=ids).order_by(*ORDERING), fields=fields)
+
+
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def get_playlists_page(cursor=None, limit=20, fields=None):
+  """
+    Returns a page of playlists, newest first, and the cursor of the next page (null on
+    the last page). Pass no cursor for the first page
+  """
+  ids, next_cursor = keyset_page(Playlist.objects.all(), cursor, max(1, min(limit, MAX_PAGE_SIZE)))
+
+  return {
+    'playlists': playlists_by_id(ids, fields) if len(ids) > 0 else [],
+    'next_cursor': next_cursor
+  }
+
+
+def export_chunks(fields):
+  """
+    The parts of the JSON array of all playlists, the playlists are read a page at a time
+  """
+  yield '['
+
+  cursor, first = None, True
+
+  while True:
+    ids, cursor = keyset_page(Playlist.objects.all(), cursor, EXPORT_PAGE_SIZE)
+
+    for playlist in playlists_by_id(ids, fields) if len(ids) > 0 else []:
+      yield ('' if first else ',') + json.dumps(playlist, cls=DjangoJSONEncoder)
+      first = False
+
+    if cursor is None:
+      break
+
+  yield ']'
+
+
+@require_GET
+def export_playlists(request):
+  """
+    Returns all playlists as a JSON array, `?fields=id,name` limits the keys of every playlist.
+
+    The response is not streamed: the app runs under ASGI, where Django 4.1 iterates a
+    StreamingHttpResponse on the event loop and the ORM cannot be used. The view itself
+    runs in a thread, so the array is built here, a page of playlists at a time
+  """
+  if not request.user.is_authenticated:
+    return HttpResponseForbidden('Authentication required')
+
+  fields = request.GET.get('fields')
+
+  return HttpResponse(
+    ''.join(export_chunks(fields.split(',') if fields else None)),
+    content_type='application/json'
+  )
+
+
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def get_playlist(playlist_id, fields=None, if_version=None):
+  """
+    Returns a playlist with all its songs, `fields` limits the keys (and columns) of every song.
+    When the playlist is still at `if_version` only its id and version are returned, with not_modified set
+  """
+  if if_version is not None:
+    version = Playlist.objects.values_list('version', flat=True).get(id=playlist_id)
+
+    if version == if_version:
+      return {'id': playlist_id, 'version': version, 'not_modified': True}
+
+  if fields is None:
+    return J(optimized(Playlist.objects).get(id=playlist_id))
+
+  playlist = Playlist.objects.select_related('creator').get(id=playlist_id)
+
+  data = JS(playlist)
+  data['creator'] = J(playlist.creator)
+  data['songs'] = J(playlist.songs.all(), fields=fields)
+
+  return data
 
 
 @rpc_method
 @set_authentication_predicate(is_authenticated)
-def get_playlist(playlist_id):
-  return J(Playlist.objects.get(id=playlist_id))
+def get_playlist_changes(playlist_id, since_version, fields=None):
+  """
+    Returns the version of a playlist and the songs that were added, updated (`fields` limits
+    their keys) and removed (ids only) after `since_version`. When the changes are not known
+    anymore resync is set and the client should call get_playlist instead
+  """
+  version, changes = changes_since(playlist_id, since_version)
+
+  if changes is None:
+    return {'id': playlist_id, 'version': version, 'resync': True}
+
+  songs = annotate_play_counts(optimized(Song.objects).filter(id__in=changes['added'] + changes['updated']))
+  songs = {song.id: J(song, fields=fields) for song in songs}
+
+  return {
+    'id': playlist_id,
+    'version': version,
+    'resync': False,
+    'added': [songs[id] for id in changes['added'] if id in songs],
+    'updated': [songs[id] for id in changes['updated'] if id in songs],
+    'removed': changes['removed'],
+  }
 
 
 @rpc_method
@@ -23,7 +153,7 @@ def get_playlist(playlist_id):
 def get_own_playlists(**kwargs):
   user = kwargs.get('request').user
 
-  return [J(x) for x in Playlist.objects.filter(creator=user)]
+  return J(Playlist.objects.filter(creator=user))
 
 
 @rpc_method
@@ -55,65 +185,152 @@ def delete_playlist(playlist_id, **kwargs):
   return True
 
 
-@rpc_method
-@set_authentication_predicate(is_authenticated)
-def add_song_to_playlist(title, artists, album, length, cover, playlist_id, platform_id, song_type, **kwargs):
-  user = kwargs.get('request').user
+SONG_FIELDS = ['title', 'artists', 'album', 'length', 'cover', 'platform_id', 'song_type']
+
+# Songs per add_songs_to_playlist call
+MAX_IMPORT_SIZE = 5000
+
+
+def validate_song(title, artists, album, length, cover, platform_id, song_type):
+  errors = []
 
-  # Cant find a better way to do this :()
   if title == "":
-    raise Exception("Song title cannot be empty")
+    errors.append("Song title cannot be empty")
 
   if artists == "":
-    raise Exception("Song artists cannot be empty")
-  
+    errors.append("Song artists cannot be empty")
+
   if album == "":
-    raise Exception("Song album cannot be empty")
+    errors.append("Song album cannot be empty")
 
-  if type(length) == 'int':
-    raise Exception("Song length is not a number")
+  if type(length) is not int:
+    errors.append("Song length is not a number")
 
   if cover == "":
-    raise Exception("Song cover cannot be empty")
-  
-  if type(playlist_id) == 'int':
-    raise Exception("Playlist id is not a number")
+    errors.append("Song cover cannot be empty")
 
   if platform_id == "":
-    raise Exception("Song platform id cannot be empty")
+    errors.append("Song platform id cannot be empty")
 
   if song_type == "":
-    raise Exception("Song type cannot be empty")
+    errors.append("Song type cannot be empty")
 
-  playlist = Playlist.objects.get(id=playlist_id)
+  # Checked here rather than by the database, MySQL truncates values in the imports
+  text_fields = {'title': title, 'artists': artists, 'album': album, 'cover': cover, 'platform_id': platform_id, 'song_type': song_type}
 
-  duplicate_song = Song.objects.filter(playlist=playlist, platform_id=platform_id)
+  for field, value in text_fields.items():
+    if type(value) is not str:
+      errors.append(f"Song {field} is not a string")
+    elif len(value) > Song._meta.get_field(field).max_length:
+      errors.append(f"Song {field} is longer than {Song._meta.get_field(field).max_length} characters")
 
-  if duplicate_song:
-    raise Exception("Song already exists in playlist")
+  if type(song_type) is str and song_type != "" and song_type not in Song.SongType.values:
+    errors.append("Song type is not valid")
 
-  if not playlist:
-    raise Exception("Playlist not found")
+  return errors
 
-  song = Song.objects.create(
-    title=title,
-    artists=artists,
-    album=album,
-    length=length,
-    cover=cover,
-    playlist=playlist,
-    added_by=user,
-    platform_id=platform_id,
-    song_type=song_type
-  )
 
-  print(song)
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def add_song_to_playlist(title, artists, album, length, cover, playlist_id, platform_id, song_type, **kwargs):
+  user = kwargs.get('request').user
+
+  errors = validate_song(title, artists, album, length, cover, platform_id, song_type)
 
-  song.save()
+  if len(errors) > 0:
+    raise Exception(errors[0])
+
+  playlist = Playlist.objects.get(id=playlist_id)
+
+  try:
+    # The database refuses a second song with the same platform id in a playlist
+    with transaction.atomic():
+      # Songs are only added with the playlist locked, see add_songs_to_playlist
+      Playlist.objects.select_for_update().get(id=playlist.id)
+
+      song = Song.objects.create(
+        title=title,
+        artists=artists,
+        album=album,
+        length=length,
+        cover=cover,
+        playlist=playlist,
+        added_by=user,
+        platform_id=platform_id,
+        song_type=song_type
+      )
+  except IntegrityError:
+    raise Exception("Song already exists in playlist")
 
   return J(song)
 
 
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def add_songs_to_playlist(playlist_id, songs, **kwargs):
+  """
+    Imports a list of songs (objects with the arguments of add_song_to_playlist) at once.
+    Returns a result per song, in the same order: created (with the song id), duplicate
+    (already in the playlist or earlier in the list) or invalid (with the errors)
+  """
+  user = kwargs.get('request').user
+
+  if type(songs) is not list:
+    raise Exception("songs must be an array")
+
+  if len(songs) > MAX_IMPORT_SIZE:
+    raise Exception(f"Cannot import more than {MAX_IMPORT_SIZE} songs at once")
+
+  playlist = Playlist.objects.get(id=playlist_id)
+
+  results = []
+  candidates = {}
+
+  for data in songs:
+    if type(data) is not dict:
+      results.append({'platform_id': None, 'status': 'invalid', 'errors': ['Song is not an object']})
+      continue
+
+    missing = [field for field in SONG_FIELDS if field not in data]
+    errors = ['Missing field: ' + field for field in missing] or validate_song(*[data[field] for field in SONG_FIELDS])
+
+    if len(errors) > 0:
+      results.append({'platform_id': data.get('platform_id'), 'status': 'invalid', 'errors': errors})
+      continue
+
+    if data['platform_id'] in candidates:
+      results.append({'platform_id': data['platform_id'], 'status': 'duplicate'})
+      continue
+
+    candidates[data['platform_id']] = Song(playlist=playlist, added_by=user, **{field: data[field] for field in SONG_FIELDS})
+    results.append({'platform_id': data['platform_id'], 'status': 'created'})
+
+  with transaction.atomic():
+    # Every song is added with the playlist locked, so no other request can add one of these
+    # songs between the check and the insert, and the ids read back are the ones inserted here
+    Playlist.objects.select_for_update().get(id=playlist.id)
+
+    existing = set(Song.objects.filter(playlist=playlist, platform_id__in=list(candidates)).values_list('platform_id', flat=True))
+    created = [platform_id for platform_id in candidates if platform_id not in existing]
+
+    Song.objects.bulk_create([candidates[platform_id] for platform_id in created], batch_size=500)
+
+    ids = dict(Song.objects.filter(playlist=playlist, added_by=user, platform_id__in=created).values_list('platform_id', 'id'))
+
+    compute_stats(playlist.id)
+
+  songs_bulk_added.send(sender=Song, playlist_id=playlist.id, song_ids=list(ids.values()))
+
+  for result in results:
+    if result['status'] == 'created':
+      if result['platform_id'] in existing:
+        result['status'] = 'duplicate'
+      else:
+        result['id'] = ids[result['platform_id']]
+
+  return results
+
+
 @rpc_method
 @set_authentication_predicate(is_authenticated)
 def delete_song_from_playlist(song_id, **kwargs):
@@ -134,7 +351,7 @@ def delete_song_from_playlist(song_id, **kwargs):
 @rpc_method
 @set_authentication_predicate(is_authenticated)
 def get_specific_song(song_id):
-  song = Song.objects.get(id=song_id)
+  song = optimized(Song.objects).get(id=song_id)
 
   if not song:
     raise Exception("Song not found")
@@ -142,42 +359,56 @@ def get_specific_song(song_id):
   return J(song)
 
 
+# Songs per search_songs call
+MAX_SEARCH_RESULTS = 50
+
+
 @rpc_method
 @set_authentication_predicate(is_authenticated)
-def get_number_of_users(playlist_id):
+def search_songs(playlist_id, query, limit=10, **kwargs):
+  """
+    Returns the songs of a playlist matching a typeahead query on title, artists and album.
+    Without a `playlist_id` the songs of all playlists created by the user are searched
+  """
+  user = kwargs.get('request').user
 
-  songs = Song.objects.filter(playlist=playlist_id)
+  if playlist_id is None:
+    playlist_ids = list(Playlist.objects.filter(creator=user).values_list('id', flat=True))
+  else:
+    playlist_ids = [playlist_id]
 
-  if not songs:
-    raise Exception("Playlist not found")
+  songs = search(playlist_ids, query, max(1, min(limit, MAX_SEARCH_RESULTS)))
+
+  return J(songs)
 
-  unique_users = []
 
-  for song in songs:
-    if song.added_by not in unique_users:
-      unique_users.append(song.added_by)
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def get_number_of_users(playlist_id):
+  stats = get_stats(playlist_id)
+
+  if stats.song_count == 0:
+    raise Exception("Playlist not found")
 
   return {
-    'song_count': len(songs),
-    'user_count': len(unique_users)
+    'song_count': stats.song_count,
+    'user_count': stats.contributor_count
   }
 
 
 @rpc_method
 @set_authentication_predicate(is_authenticated)
-def get_playlist_users(playlist_id):
-  songs = Song.objects.filter(playlist=playlist_id)
-
-  if not songs:
-    return []
-
-  unique_users = []
+def get_playlist_stats(playlist_id):
+  """
+    Returns the number of songs, the number of contributors and the total length of a playlist
+  """
+  return J(get_stats(playlist_id))
 
-  for song in songs:
-    if song.added_by not in unique_users:
-      unique_users.append(song.added_by)
 
-  return [J(x) for x in unique_users]
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def get_playlist_users(playlist_id):
+  return J(User.objects.filter(song__playlist=playlist_id).distinct())
 
 
 @rpc_method
@@ -188,7 +419,6 @@ def increment_play_count(playlist_id, song_id):
   if not song:
     raise Exception("Song not found")
 
-  song.play_count += 1
-  song.save()
+  increment_play_counter(song.id)
 
   return J(song)
\ No newline at end of file
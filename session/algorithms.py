@@ -0,0 +1,246 @@
+import time
+import random
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from playlist.models import Song
+from playlist.signals import play_counts_flushed, songs_bulk_added
+from session.shuffle import next_songs
+from tawa3.tools import new_version
+
+redis = get_redis_connection('default')
+
+
+# Queue generation algorithms by the name stored in SessionSettings.algorithm_used
+ALGORITHMS = {}
+
+def algorithm(name):
+  def register(fn):
+    ALGORITHMS[name] = fn
+    return fn
+
+  return register
+
+
+# Sessions are cleaned up after a day, so is their play history
+PLAYED_TTL = 60 * 60 * 24
+
+
+def songs_version_key(playlist_id):
+  return f'playlist::{playlist_id}::songs_version'
+
+
+def played_key(session_id):
+  return f'session::{session_id}::played'
+
+
+def round_robin_key(session_id):
+  return f'session::{session_id}::round_robin'
+
+
+class PlaylistSongs:
+  """
+    The songs of a playlist as compact arrays, index i of every array belongs to
+    the same song. Loaded with a single query and kept in memory per playlist
+  """
+
+  def __init__(self, playlist_id):
+    self.playlist_id = playlist_id
+
+    rows = Song.objects.filter(playlist_id=playlist_id).order_by('id').values_list('id', 'play_count', 'added_by_id')
+
+    self.ids = array('q')
+    self.play_counts = array('q')
+    self.added_by = array('q')
+
+    for id, play_count, added_by in rows:
+      self.ids.append(id)
+      self.play_counts.append(play_count)
+      self.added_by.append(added_by or 0)
+
+    # Songs that were played less get picked more often
+    self.cum_weights = array('d')
+    total = 0.0
+    for play_count in self.play_counts:
+      total += 1.0 / (1 + play_count)
+      self.cum_weights.append(total)
+
+    # Song indices per contributor, for the round robin
+    self.by_contributor = {}
+    for idx, added_by in enumerate(self.added_by):
+      self.by_contributor.setdefault(added_by, array('q')).append(idx)
+    self.contributors = sorted(self.by_contributor)
+
+  def __len__(self):
+    return len(self.ids)
+
+
+# Playlists a worker keeps loaded, the least recently used one is dropped first
+MAX_LOADED_PLAYLISTS = 32
+
+# playlist id -> (songs version, PlaylistSongs), least recently used first
+loaded_playlists = OrderedDict()
+loaded_playlists_lock = threading.Lock()
+
+def get_playlist_songs(playlist_id):
+  """
+    Returns the PlaylistSongs of a playlist, they are only reloaded when a song
+    of the playlist was added, changed or deleted on any worker
+  """
+  version = redis.get(songs_version_key(playlist_id))
+
+  with loaded_playlists_lock:
+    loaded = loaded_playlists.get(playlist_id)
+
+    if loaded is not None and loaded[0] == version:
+      loaded_playlists.move_to_end(playlist_id)
+      return loaded[1]
+
+  loaded = (version, PlaylistSongs(playlist_id))
+
+  with loaded_playlists_lock:
+    loaded_playlists[playlist_id] = loaded
+    loaded_playlists.move_to_end(playlist_id)
+
+    while len(loaded_playlists) > MAX_LOADED_PLAYLISTS:
+      loaded_playlists.popitem(last=False)
+
+  return loaded[1]
+
+
+@receiver(post_save, sender=Song)
+@receiver(post_delete, sender=Song)
+def bump_songs_version(sender, instance, **kwargs):
+  redis.set(songs_version_key(instance.playlist_id), new_version())
+
+
+@receiver(songs_bulk_added)
+def bump_imported_songs_version(sender, playlist_id, **kwargs):
+  redis.set(songs_version_key(playlist_id), new_version())
+
+
+@receiver(play_counts_flushed)
+def bump_played_songs_version(sender, playlist_ids, **kwargs):
+  # The play count weights changed
+  pipeline = redis.pipeline(transaction=False)
+  for playlist_id in playlist_ids:
+    pipeline.set(songs_version_key(playlist_id), new_version())
+  pipeline.execute()
+
+
+def pick_unique(songs, count, exclude, draw):
+  """
+    Calls `draw` for song indices until `count` songs are picked that are not excluded,
+    gives up after a bounded number of draws so tiny playlists do not loop forever
+  """
+  picked = []
+  seen = set(exclude)
+
+  for _ in range(count * 10 + 10):
+    if len(picked) == count:
+      break
+
+    id = songs.ids[draw()]
+
+    if id not in seen:
+      seen.add(id)
+      picked.append(id)
+
+  return picked
+
+
+@algorithm('random')
+def random_songs(songs, count, session_id, exclude):
+  # Walks the no-repeat shuffle of the session, so songs only repeat once all of them were played
+  picked = []
+  exclude = set(exclude)
+
+  for _ in range(2):
+    picked += [id for id in next_songs(session_id, songs.playlist_id, count - len(picked)) if id not in exclude]
+
+    if len(picked) == count:
+      break
+
+  return picked
+
+
+@algorithm('play_count')
+def play_count_weighted_songs(songs, count, session_id, exclude):
+  total = songs.cum_weights[-1]
+
+  last = len(songs) - 1
+
+  return pick_unique(songs, count, exclude, lambda: min(bisect.bisect_right(songs.cum_weights, random.random() * total), last))
+
+
+@algorithm('least_recently_played')
+def least_recently_played_songs(songs, count, session_id, exclude):
+  # Songs this session played, oldest first
+  played = [int(id) for id in redis.zrange(played_key(session_id), 0, -1)]
+  played_set = set(played)
+
+  # Songs that were never played in this session come first, in random order
+  picked = pick_unique(songs, count, played_set | set(exclude), lambda: random.randrange(len(songs)))
+
+  # Then the songs that were played the longest time ago
+  if len(picked) < count:
+    exclude = set(exclude) | set(picked)
+    picked += [id for id in played if id not in exclude][:count - len(picked)]
+
+  return picked
+
+
+@algorithm('round_robin')
+def contributor_round_robin_songs(songs, count, session_id, exclude):
+  # Continue with the contributor after the one that got the last turn
+  turn = int(redis.get(round_robin_key(session_id)) or 0)
+  contributors = songs.contributors
+
+  picked = []
+  seen = set(exclude)
+
+  for _ in range(count * 10 + 10):
+    if len(picked) == count:
+      break
+
+    indices = songs.by_contributor[contributors[turn % len(contributors)]]
+    turn += 1
+
+    id = songs.ids[indices[random.randrange(len(indices))]]
+
+    if id not in seen:
+      seen.add(id)
+      picked.append(id)
+
+  redis.set(round_robin_key(session_id), turn % len(contributors))
+
+  return picked
+
+
+def generate(algorithm_used, playlist_id, count, session_id, exclude=()):
+  """
+    Picks the next `count` song ids of a session with the given algorithm,
+    songs in `exclude` (the queue, the current song) are skipped
+  """
+  if algorithm_used not in ALGORITHMS:
+    raise Exception('Unknown queue algorithm: ' + algorithm_used)
+
+  songs = get_playlist_songs(playlist_id)
+
+  if len(songs) == 0:
+    return []
+
+  return ALGORITHMS[algorithm_used](songs, count, session_id, exclude)
+
+
+def mark_played(session_id, song_id):
+  pipeline = redis.pipeline(transaction=True)
+  pipeline.zadd(played_key(session_id), {song_id: time.time()})
+  pipeline.expire(played_key(session_id), PLAYED_TTL)
+  pipeline.execute()
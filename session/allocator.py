@@ -0,0 +1,81 @@
+import time
+from itertools import product
+
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+redis = get_redis_connection('default')
+
+
+class SessionIdPool:
+  """
+    Keeps every session id that is not in use in a Redis set. Allocating pops a random
+    member (SPOP), which is atomic, so two workers can never get the same id and the
+    cost does not depend on how many sessions exist. Deleted sessions return their id.
+    The pool is filled from the database on first use (or after Redis lost it)
+  """
+
+  def __init__(self, allowed_chars, length):
+    self.allowed_chars = allowed_chars
+    self.length = length
+    self.key = 'session::free_ids'
+    self.filled_key = 'session::free_ids::filled'
+    self.fill_lock_key = 'session::free_ids::fill_lock'
+
+  def allocate(self, used_ids):
+    """
+      Returns a free session id, `used_ids` is only called (to get the ids that are in use) when the pool has to be filled
+    """
+    session_id = redis.spop(self.key)
+
+    if session_id is None:
+      if redis.exists(self.filled_key):
+        raise Exception('No free session ids left')
+
+      self.fill(used_ids)
+      return self.allocate(used_ids)
+
+    return session_id.decode('utf-8')
+
+  def release(self, session_ids):
+    if len(session_ids) > 0:
+      redis.sadd(self.key, *session_ids)
+
+  def fill(self, used_ids):
+    # Only one worker fills the pool, the others wait for it to finish
+    if not redis.set(self.fill_lock_key, 1, nx=True, ex=60):
+      while redis.exists(self.fill_lock_key) and not redis.exists(self.filled_key):
+        time.sleep(0.1)
+      return
+
+    try:
+      used = set(used_ids())
+      free = (''.join(chars) for chars in product(self.allowed_chars, repeat=self.length))
+
+      pipeline = redis.pipeline(transaction=False)
+      chunk = []
+
+      for session_id in free:
+        if session_id not in used:
+          chunk.append(session_id)
+
+        if len(chunk) == 10000:
+          pipeline.sadd(self.key, *chunk)
+          chunk = []
+
+      if len(chunk) > 0:
+        pipeline.sadd(self.key, *chunk)
+
+      pipeline.set(self.filled_key, 1)
+      pipeline.execute()
+    finally:
+      redis.delete(self.fill_lock_key)
+
+
+session_id_pool = SessionIdPool('ABCDEFGHIJKLNOPQRSTUVXYZ', 4)
+
+
+@receiver(post_delete, sender='session.Session')
+def release_session_id(sender, instance, **kwargs):
+  session_id_pool.release([instance.session_id])
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class SessionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'session'
+
+    def ready(self):
+        # Registers the signal receivers
+        import session.algorithms
+        import session.shuffle
+        import session.cascades
@@ -0,0 +1,89 @@
+import threading
+
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from session.models import Session, Queue, CurrentlyPlaying
+from session.state import refresh_state
+
+redis = get_redis_connection('default')
+
+
+def origin_model(origin):
+  return origin.model if isinstance(origin, QuerySet) else type(origin)
+
+
+def close_queue_gaps(session_ids):
+  """
+    Renumbers the queues of the sessions to 0..n-1 again, the queue operations expect
+    that. The sessions are locked like the queue operations lock them. Returns the
+    session codes of the sessions that still exist
+  """
+  with transaction.atomic():
+    sessions = list(Session.objects.select_for_update().filter(id__in=session_ids).order_by('id').values_list('session_id', flat=True))
+
+    changed = []
+    session_id, position = None, 0
+
+    for queue in Queue.objects.filter(session_id__in=session_ids).only('id', 'session_id', 'position').order_by('session_id', 'position', 'id'):
+      if queue.session_id != session_id:
+        session_id, position = queue.session_id, 0
+
+      if queue.position != position:
+        queue.position = position
+        changed.append(queue)
+
+      position += 1
+
+    Queue.objects.bulk_update(changed, ['position'], batch_size=1000)
+
+  return sessions
+
+
+def refresh_queues(session_ids):
+  for session_id in close_queue_gaps(session_ids):
+    refresh_state(redis, session_id, 'queue')
+
+
+def refresh_currently_playing(session_ids):
+  for session_id in Session.objects.filter(id__in=session_ids).values_list('session_id', flat=True):
+    refresh_state(redis, session_id, 'currently_playing')
+
+
+# delete() sends post_delete per row, the sessions are collected per delete() call and
+# fixed once when it is committed
+deleting = threading.local()
+
+
+def sessions_for_delete(origin, model, fix):
+  cache = getattr(deleting, model.__name__, None)
+
+  if cache is None or cache[0] is not origin:
+    session_ids = set()
+    cache = (origin, session_ids)
+    setattr(deleting, model.__name__, cache)
+    transaction.on_commit(lambda: fix(session_ids))
+
+  return cache[1]
+
+
+@receiver(post_delete, sender=Queue)
+def queue_entry_deleted(sender, instance, origin=None, **kwargs):
+  # The queue operations keep the positions and the snapshot themselves, a deleted
+  # session takes its queue along
+  if origin_model(origin) in (Queue, Session):
+    return
+
+  sessions_for_delete(origin, Queue, refresh_queues).add(instance.session_id)
+
+
+@receiver(post_delete, sender=CurrentlyPlaying)
+def currently_playing_deleted(sender, instance, origin=None, **kwargs):
+  # set_currently_playing stores the snapshot itself
+  if origin_model(origin) in (CurrentlyPlaying, Session):
+    return
+
+  sessions_for_delete(origin, CurrentlyPlaying, refresh_currently_playing).add(instance.session_id)
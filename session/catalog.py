@@ -0,0 +1,86 @@
+import json
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from tawa3.tools import new_version
+
+redis = get_redis_connection('default')
+
+
+class EventCatalog:
+  """
+    All KokopelliEvents in memory, by name and by id. The events hardly ever change, so
+    instead of querying them every worker only checks a version number in Redis, which
+    is replaced when an event is saved or deleted (in the admin), and reloads when it changed
+  """
+
+  version_key = 'kokopelli_events::version'
+
+  def __init__(self):
+    self.version = None
+    self.by_name = {}
+    self.by_id = {}
+
+  def load(self):
+    version = redis.get(self.version_key) or b'0'
+
+    if version != self.version:
+      events = list(apps.get_model('session', 'KokopelliEvent').objects.all())
+
+      self.by_name = {event.name: event for event in events}
+      self.by_id = {event.id: event for event in events}
+      self.version = version
+
+  def get(self, name):
+    self.load()
+    return self.by_name.get(name)
+
+  def get_by_ids(self, ids):
+    self.load()
+    return [self.by_id[id] for id in ids if id in self.by_id]
+
+  def invalidate(self):
+    redis.set(self.version_key, new_version())
+
+
+event_catalog = EventCatalog()
+
+
+# Same lifetime as the session snapshot, keys of sessions that were deleted by a cascade expire
+ALLOWED_EVENTS_TTL = 60 * 60 * 24
+
+
+def allowed_events_key(settings_id):
+  return f'session_settings::{settings_id}::allowed_events'
+
+
+def get_allowed_event_ids(session_settings):
+  """
+    The ids of the allowed events of a session, cached in Redis so serializing
+    the settings does not query the many to many table every time
+  """
+  key = allowed_events_key(session_settings.pk)
+  ids = redis.get(key)
+
+  if ids is None:
+    ids = list(session_settings.allowed_events.values_list('id', flat=True))
+    redis.set(key, json.dumps(ids), ex=ALLOWED_EVENTS_TTL)
+    return ids
+
+  return json.loads(ids)
+
+
+@receiver(post_save, sender='session.KokopelliEvent')
+@receiver(post_delete, sender='session.KokopelliEvent')
+def invalidate_event_catalog(sender, **kwargs):
+  transaction.on_commit(event_catalog.invalidate)
+
+
+@receiver(m2m_changed, sender='session.SessionSettings_allowed_events')
+def invalidate_allowed_events(sender, instance, action, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    transaction.on_commit(lambda: redis.delete(allowed_events_key(instance.pk)))
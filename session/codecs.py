@@ -0,0 +1,133 @@
+import json
+from urllib.parse import parse_qs
+
+import msgpack
+
+try:
+  import cbor2
+except ImportError:
+  cbor2 = None
+
+from django.conf import settings
+
+
+class JSONCodec:
+  name = 'json'
+  binary = False
+
+  def encode(self, obj):
+    return json.dumps(obj)
+
+  def decode(self, data):
+    return json.loads(data)
+
+
+class MessagePackCodec:
+  name = 'msgpack'
+  binary = True
+
+  def encode(self, obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+  def decode(self, data):
+    return msgpack.unpackb(data, raw=False)
+
+
+class CBORCodec:
+  name = 'cbor'
+  binary = True
+
+  def encode(self, obj):
+    return cbor2.dumps(obj)
+
+  def decode(self, data):
+    return cbor2.loads(data)
+
+
+json_codec = JSONCodec()
+
+# CBOR is only offered when cbor2 is installed, msgpack comes with channels_redis
+CODECS = {
+  codec.name: codec for codec in [json_codec, MessagePackCodec()] + ([CBORCodec()] if cbor2 else [])
+}
+
+SUBPROTOCOL_PREFIX = 'kokopelli.'
+
+# Carries the access token of browsers, see tawa3.middleware.TokenAuthMiddleware
+TOKEN_SUBPROTOCOL_PREFIX = SUBPROTOCOL_PREFIX + 'token.'
+
+
+def negotiate_codec(scope):
+  """
+    Picks the wire format of a websocket connection. A `kokopelli.<format>` subprotocol
+    wins over the `format` query parameter, clients that ask for neither (or for a
+    format we do not know) get JSON. Returns the codec and the subprotocol to accept.
+    A browser aborts the handshake when none of its subprotocols is accepted, so the
+    token subprotocol is accepted when it is the only one of ours that was offered
+  """
+  token_subprotocol = None
+
+  for subprotocol in scope.get('subprotocols', []):
+    if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+      token_subprotocol = token_subprotocol or subprotocol
+    elif subprotocol.startswith(SUBPROTOCOL_PREFIX):
+      codec = CODECS.get(subprotocol[len(SUBPROTOCOL_PREFIX):])
+
+      if codec is not None:
+        return codec, subprotocol
+
+  query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+  codec = CODECS.get(query.get('format', ['json'])[0], json_codec)
+
+  return codec, token_subprotocol
+
+
+def decode_message(codec, text_data=None, bytes_data=None):
+  """
+    Decodes an incoming websocket frame, text frames are always JSON
+  """
+  if bytes_data is not None and codec.binary:
+    return codec.decode(bytes_data)
+
+  return json_codec.decode(text_data)
+
+
+def encode_message(codec, obj):
+  """
+    Encodes an outgoing websocket frame, returns the keyword arguments for `send`
+  """
+  if codec.binary:
+    return {'bytes_data': codec.encode(obj)}
+
+  return {'text_data': codec.encode(obj)}
+
+
+def storage_codec():
+  return CODECS.get(getattr(settings, 'SESSION_EVENT_STORAGE_FORMAT', 'json'), json_codec)
+
+
+def encode_stored_event(event):
+  """
+    Encodes an event for the session::<id> history list and the event log
+  """
+  return storage_codec().encode(event)
+
+
+def decode_stored_event(data):
+  """
+    Decodes a stored event. Entries written before the storage format was changed
+    may use another format, so it is detected from the first byte. Events are always
+    maps: '{' for JSON, 0x80-0x8f/0xde/0xdf for msgpack and 0xa0-0xbf for CBOR
+  """
+  first = data[0]
+
+  if first == ord('{'):
+    return json_codec.decode(data)
+
+  if 0x80 <= first <= 0x8f or first in (0xde, 0xdf):
+    return CODECS['msgpack'].decode(data)
+
+  if 0xa0 <= first <= 0xbf and 'cbor' in CODECS:
+    return CODECS['cbor'].decode(data)
+
+  raise ValueError('Unknown event encoding')
@@ -1,21 +1,159 @@
-import json
-
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.db import database_sync_to_async
 from asgiref.sync import async_to_sync
 
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django_redis import get_redis_connection
 
+import redis.asyncio as aioredis
+
+from session.codecs import negotiate_codec, decode_message, encode_message, encode_stored_event
+from session.events import EventHistoryWriter, AsyncEventHistoryWriter, EventCoalescer, read_log_since, async_read_log_since, get_last_event_id
+from session.permissions import read_settings, async_read_settings, allows_connect, allows_event, needs_permission, is_owner
+from user.tokens import resolve_token, cached_token
+
+
+# One async Redis client per process, its connection pool is shared by all consumers
+async_redis = None
+
+def get_async_redis_connection():
+  global async_redis
+
+  if async_redis is None:
+    async_redis = aioredis.from_url(settings.CACHES['default']['LOCATION'])
+
+  return async_redis
+
+
+# One event writer per process, so the events of all sessions can be flushed together
+async_event_writer = None
+
+def get_async_event_writer():
+  global async_event_writer
+
+  if async_event_writer is None:
+    async_event_writer = AsyncEventHistoryWriter(
+      get_async_redis_connection(),
+      flush_interval=getattr(settings, 'SESSION_EVENT_FLUSH_INTERVAL', None)
+    )
+
+  return async_event_writer
+
+
+async def publish_event(session_id, event_json):
+  """
+    Stores an event in the history and sends it to all clients of the session
+  """
+  event_id = await get_async_event_writer().write(session_id, encode_stored_event(event_json))
+
+  await get_channel_layer().group_send(
+    session_id,
+    {"type": "event", "event": {
+      'errors': [],
+      'event_data': event_json,
+      'id': event_id
+    }}
+  )
+
+
+# Merges high frequency player events per session before they are published
+event_coalescer = EventCoalescer(getattr(settings, 'SESSION_COALESCED_EVENTS', {}), publish_event)
+
+
+@database_sync_to_async
+def rebuild_settings(session_id):
+  return read_settings(get_redis_connection('default'), session_id)
+
+
+def current_user(scope):
+  """
+    The user of a connection, anonymous once its access token expired or was revoked.
+    The token is looked up in the token cache, not the database
+  """
+  access_token = scope.get('access_token')
+
+  if access_token is None:
+    return AnonymousUser()
+
+  access_token = cached_token(access_token.token) or resolve_token(access_token.token)
+
+  return access_token.user if access_token else AnonymousUser()
+
+
+async def async_current_user(scope):
+  access_token = scope.get('access_token')
+
+  if access_token is None:
+    return AnonymousUser()
+
+  access_token = cached_token(access_token.token) or await database_sync_to_async(resolve_token)(access_token.token)
+
+  return access_token.user if access_token else AnonymousUser()
+
+
+def sender(user):
+  return user.toJSON() if user.is_authenticated else None
+
+
+def can_see_history(session_settings, user):
+  return session_settings is None or is_owner(session_settings, user) or session_settings.get('anyone_can_see_history', True)
+
+
+def validate_json(obj):
+  errors = []
+
+  if not 'session_id' in obj:
+    errors.append('Session ID not found in JSON object')
+
+  if not 'client_type' in obj:
+    errors.append('Client type not found in JSON object')
+
+  if not 'event_type' in obj:
+    errors.append('Event type not found in JSON object')
+
+  if not 'data' in obj:
+    errors.append('Data not found in JSON object')
+
+  if not 'date' in obj:
+    errors.append('Date not found in JSON object')
+
+  return errors
+
+
 class SessionConsumer(WebsocketConsumer):
   def connect(self):
     self.session_id = self.scope['url_route']['kwargs']['session_id']
     self.redis = get_redis_connection('default')
+    self.writer = EventHistoryWriter(self.redis)
+    self.codec, subprotocol = negotiate_codec(self.scope)
+
+    user = self.scope.get('user', AnonymousUser())
+    session_settings = read_settings(self.redis, self.session_id)
+
+    if not allows_connect(session_settings, user):
+      self.close()
+      return
 
     async_to_sync(self.channel_layer.group_add)(
       self.session_id,
       self.channel_name
     )
 
-    self.accept()
+    self.accept(subprotocol)
+
+    # Replay the events a reconnecting client missed, it dedupes on the event id
+    last_event_id = get_last_event_id(self.scope)
+
+    if last_event_id is not None and can_see_history(session_settings, user):
+      for missed in read_log_since(self.redis, self.session_id, last_event_id):
+        event_id = missed.pop('id')
+        self.send(**encode_message(self.codec, {
+          'errors': [],
+          'event_data': missed,
+          'id': event_id
+        }))
 
 
   def disconnect(self, close_code):
@@ -25,60 +163,140 @@ class SessionConsumer(WebsocketConsumer):
     )
 
   def validate_json(self, obj):
-    errors = []
-
-    if not 'session_id' in obj:
-      errors.append('Session ID not found in JSON object')
-
-    if not 'client_type' in obj:
-      errors.append('Client type not found in JSON object')
-
-    if not 'event_type' in obj:
-      errors.append('Event type not found in JSON object')
+    return validate_json(obj)
 
-    if not 'data' in obj:
-      errors.append('Data not found in JSON object')
 
-    if not 'date' in obj:
-      errors.append('Date not found in JSON object')
 
-    return errors
-
-
-
-  def receive(self, text_data):
+  def receive(self, text_data=None, bytes_data=None):
     event_json = '{}'
     try:
-      event_json = json.loads(text_data)
+      event_json = decode_message(self.codec, text_data, bytes_data)
       errors = self.validate_json(event_json)
     except:
-      errors = ['Invalid JSON']
+      errors = [f'Invalid {self.codec.name.upper()}']
 
     if len(errors) > 0:
-      self.send(text_data=json.dumps({
+      self.send(**encode_message(self.codec, {
         'errors': errors
       }))
       return
 
+    user = current_user(self.scope)
+
+    if needs_permission(event_json['event_type']) and not allows_event(read_settings(self.redis, self.session_id), user, event_json['event_type']):
+      self.send(**encode_message(self.codec, {
+        'errors': [f'Not allowed to send {event_json["event_type"]} events in this session']
+      }))
+      return
+
+    # The sender is who the token belongs to, not what the client claims
+    event_json['user'] = sender(user)
+
     # no errors, so we can set the cache and dump the event to all clients
-    pipeline = self.redis.pipeline()
-    # Push the event to the list
-    self.redis.lpush(f'session::{self.session_id}', text_data)
-    # Trim the list to 100 elements
-    self.redis.ltrim(f'session::{self.session_id}', 0, 99)
-    # Execute the pipeline!
-    pipeline.execute()
+    event_id = self.writer.write(self.session_id, encode_stored_event(event_json))
 
     # Send the event to all clients
     async_to_sync(self.channel_layer.group_send)(
       self.session_id,
       {"type": "event", "event": {
         'errors': errors,
-        'event_data': event_json
+        'event_data': event_json,
+        'id': event_id
       }}
     )
 
 
   def event(self, event):
-    self.send(text_data=json.dumps(event['event']))
-  
\ No newline at end of file
+    self.send(**encode_message(self.codec, event['event']))
+
+
+class AsyncSessionConsumer(AsyncWebsocketConsumer):
+  """
+    Same protocol as SessionConsumer, but runs on the event loop instead of
+    borrowing a thread from the pool for every connect, receive and fanout
+  """
+
+  async def connect(self):
+    self.session_id = self.scope['url_route']['kwargs']['session_id']
+    self.redis = get_async_redis_connection()
+    self.codec, subprotocol = negotiate_codec(self.scope)
+
+    user = self.scope.get('user', AnonymousUser())
+    session_settings = await async_read_settings(self.redis, self.session_id, rebuild_settings)
+
+    if not allows_connect(session_settings, user):
+      await self.close()
+      return
+
+    await self.channel_layer.group_add(
+      self.session_id,
+      self.channel_name
+    )
+
+    await self.accept(subprotocol)
+
+    # Replay the events a reconnecting client missed, it dedupes on the event id
+    last_event_id = get_last_event_id(self.scope)
+
+    if last_event_id is not None and can_see_history(session_settings, user):
+      for missed in await async_read_log_since(self.redis, self.session_id, last_event_id):
+        event_id = missed.pop('id')
+        await self.send(**encode_message(self.codec, {
+          'errors': [],
+          'event_data': missed,
+          'id': event_id
+        }))
+
+
+  async def disconnect(self, close_code):
+    await self.channel_layer.group_discard(
+      self.session_id,
+      self.channel_name
+    )
+
+  def validate_json(self, obj):
+    return validate_json(obj)
+
+
+  async def receive(self, text_data=None, bytes_data=None):
+    event_json = '{}'
+    try:
+      event_json = decode_message(self.codec, text_data, bytes_data)
+      errors = self.validate_json(event_json)
+    except:
+      errors = [f'Invalid {self.codec.name.upper()}']
+
+    if len(errors) > 0:
+      await self.send(**encode_message(self.codec, {
+        'errors': errors
+      }))
+      return
+
+    user = await async_current_user(self.scope)
+
+    if needs_permission(event_json['event_type']):
+      session_settings = await async_read_settings(self.redis, self.session_id, rebuild_settings)
+
+      if not allows_event(session_settings, user, event_json['event_type']):
+        await self.send(**encode_message(self.codec, {
+          'errors': [f'Not allowed to send {event_json["event_type"]} events in this session']
+        }))
+        return
+
+    # The sender is who the token belongs to, not what the client claims
+    event_json['user'] = sender(user)
+
+    # Progress ticks and the like are merged, only the latest one is published
+    if event_coalescer.coalesces(event_json['event_type']):
+      event_coalescer.add(self.session_id, event_json['event_type'], event_json)
+      return
+
+    # Pending progress ticks and the like were sent before this event
+    await event_coalescer.flush(self.session_id)
+
+    # no errors, so we can set the cache and dump the event to all clients
+    await publish_event(self.session_id, event_json)
+
+
+  async def event(self, event):
+    await self.send(**encode_message(self.codec, event['event']))
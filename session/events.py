@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import re
+from urllib.parse import parse_qs
+
+from session.codecs import decode_stored_event
+
+logger = logging.getLogger(__name__)
+
+
+# Number of events kept in the session::<id> history list
+HISTORY_LENGTH = 100
+
+# Number of events kept in the resumable session::<id>::log stream, the
+# log is trimmed approximately so it can hold slightly more than this
+LOG_LENGTH = 1000
+
+# The ids Redis gives the entries of a stream, <milliseconds>-<sequence>
+EVENT_ID = re.compile(r'\d+-\d+')
+
+
+def history_key(session_id):
+  return f'session::{session_id}'
+
+
+def log_key(session_id):
+  return f'session::{session_id}::log'
+
+
+def queue_event(pipeline, session_id, payload):
+  """
+    Queues the commands that store one event on a pipeline: push it to the history
+    list, trim the list and append it to the resumable log. The stream id of the
+    event is the last result of these commands
+  """
+  pipeline.lpush(history_key(session_id), payload)
+  pipeline.ltrim(history_key(session_id), 0, HISTORY_LENGTH - 1)
+  pipeline.xadd(log_key(session_id), {'event': payload}, maxlen=LOG_LENGTH, approximate=True)
+
+
+class EventHistoryWriter:
+  """
+    Stores events for the RPC and the sync consumer, every event is written
+    atomically (MULTI/EXEC) in a single round trip
+  """
+
+  def __init__(self, redis):
+    self.redis = redis
+
+  def write(self, session_id, payload):
+    pipeline = self.redis.pipeline(transaction=True)
+    queue_event(pipeline, session_id, payload)
+    event_id = pipeline.execute()[-1]
+
+    return event_id.decode('utf-8')
+
+
+class AsyncEventHistoryWriter:
+  """
+    Stores events for the async consumer. Without a flush interval every event
+    is written atomically in its own round trip. With a flush interval (in seconds)
+    events of all sessions are queued and flushed together in one pipeline every
+    few milliseconds, writers wait for the flush to get the id of their event
+  """
+
+  def __init__(self, redis, flush_interval=None):
+    self.redis = redis
+    self.flush_interval = flush_interval
+    self.queued = []
+    self.flusher = None
+
+  async def write(self, session_id, payload):
+    if not self.flush_interval:
+      pipeline = self.redis.pipeline(transaction=True)
+      queue_event(pipeline, session_id, payload)
+      event_id = (await pipeline.execute())[-1]
+
+      return event_id.decode('utf-8')
+
+    future = asyncio.get_running_loop().create_future()
+    self.queued.append((session_id, payload, future))
+
+    if self.flusher is None:
+      self.flusher = asyncio.ensure_future(self.flush_later())
+
+    return await future
+
+  async def flush_later(self):
+    await asyncio.sleep(self.flush_interval)
+
+    # Events queued from now on are picked up by the next flush
+    queued = self.queued
+    self.queued = []
+    self.flusher = None
+
+    await self.flush(queued)
+
+  async def flush(self, queued):
+    pipeline = self.redis.pipeline(transaction=True)
+
+    for session_id, payload, _ in queued:
+      queue_event(pipeline, session_id, payload)
+
+    try:
+      results = await pipeline.execute()
+    except Exception as e:
+      for _, _, future in queued:
+        if not future.done():
+          future.set_exception(e)
+      return
+
+    # Every event queued three commands, the third one is the XADD
+    for idx, (_, _, future) in enumerate(queued):
+      if not future.done():
+        future.set_result(results[idx * 3 + 2].decode('utf-8'))
+
+
+class EventCoalescer:
+  """
+    Merges high frequency "latest value wins" events (progress ticks, volume changes)
+    per session and event type. The first event of a type opens a window, events
+    arriving inside the window replace it and only the latest one is published
+    when the window closes. `windows` maps event types to their window in seconds,
+    other event types are never coalesced. Call flush before publishing any other
+    event of the session, so the pending events are not published after it
+  """
+
+  def __init__(self, windows, publish):
+    self.windows = windows
+    self.publish = publish
+    # (session id, event type) -> [latest event, timer of the window]
+    self.pending = {}
+    # publish tasks of closed windows -> their session id
+    self.tasks = {}
+
+  def coalesces(self, event_type):
+    return isinstance(event_type, str) and event_type in self.windows
+
+  def add(self, session_id, event_type, event_json):
+    key = (session_id, event_type)
+
+    if key in self.pending:
+      # Latest value wins
+      self.pending[key][0] = event_json
+      return
+
+    timer = asyncio.get_running_loop().call_later(self.windows[event_type], self.close_window, key)
+    self.pending[key] = [event_json, timer]
+
+  def close_window(self, key):
+    event_json, _ = self.pending.pop(key)
+
+    task = asyncio.ensure_future(self.publish(key[0], event_json))
+    self.tasks[task] = key[0]
+    task.add_done_callback(self.task_done)
+
+  def task_done(self, task):
+    self.tasks.pop(task, None)
+
+    if not task.cancelled() and task.exception() is not None:
+      logger.error('Publishing a coalesced event failed', exc_info=task.exception())
+
+  async def flush(self, session_id):
+    """
+      Publishes the pending events of a session right away and waits for the ones
+      whose window already closed, so they are stored and sent before what comes next
+    """
+    keys = [key for key in self.pending if key[0] == session_id]
+
+    for key in keys:
+      event_json, timer = self.pending.pop(key)
+      timer.cancel()
+      await self.publish(session_id, event_json)
+
+    in_flight = [task for task, task_session_id in self.tasks.items() if task_session_id == session_id]
+
+    if len(in_flight) > 0:
+      await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+def decode_log(entries):
+  """
+    Turns the raw (id, fields) tuples returned by XRANGE into events,
+    every event gets its stream id attached so clients can resume from it
+  """
+  events = []
+
+  for event_id, fields in entries:
+    event = decode_stored_event(fields[b'event'])
+    event['id'] = event_id.decode('utf-8')
+    events.append(event)
+
+  return events
+
+
+def is_event_id(event_id):
+  return isinstance(event_id, str) and EVENT_ID.fullmatch(event_id) is not None
+
+
+def read_log_since(redis, session_id, since):
+  """
+    Returns all events in the log that come after the `since` event id, oldest first
+  """
+  return decode_log(redis.xrange(log_key(session_id), min=f'({since}', max='+', count=LOG_LENGTH))
+
+
+async def async_read_log_since(redis, session_id, since):
+  entries = await redis.xrange(log_key(session_id), min=f'({since}', max='+', count=LOG_LENGTH)
+  return decode_log(entries)
+
+
+def get_last_event_id(scope):
+  """
+    Reads the last event id a reconnecting client has seen from the websocket query string,
+    an id that is not a stream id is ignored
+  """
+  query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+  last_event_id = query.get('last_event_id', [None])[0]
+
+  return last_event_id if is_event_id(last_event_id) else None
@@ -0,0 +1,128 @@
+import json
+import time
+import asyncio
+from contextlib import contextmanager
+
+import redis.connection
+import redis.asyncio.connection
+import redis.asyncio as aioredis
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from session.events import EventHistoryWriter, AsyncEventHistoryWriter, history_key, log_key, HISTORY_LENGTH, LOG_LENGTH
+
+
+@contextmanager
+def count_round_trips():
+  """
+    Counts the packed command writes to Redis, a pipeline is sent as one packed
+    write so this is the number of round trips
+  """
+  counter = {'round_trips': 0}
+
+  sync_send = redis.connection.Connection.send_packed_command
+  async_send = redis.asyncio.connection.Connection.send_packed_command
+
+  def counting_sync_send(self, *args, **kwargs):
+    counter['round_trips'] += 1
+    return sync_send(self, *args, **kwargs)
+
+  async def counting_async_send(self, *args, **kwargs):
+    counter['round_trips'] += 1
+    return await async_send(self, *args, **kwargs)
+
+  redis.connection.Connection.send_packed_command = counting_sync_send
+  redis.asyncio.connection.Connection.send_packed_command = counting_async_send
+
+  try:
+    yield counter
+  finally:
+    redis.connection.Connection.send_packed_command = sync_send
+    redis.asyncio.connection.Connection.send_packed_command = async_send
+
+
+class Command(BaseCommand):
+  help = 'Measures the Redis round trips per stored session event, before and after the event history writer'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--events', type=int, default=1000, help='Number of events to write per run')
+    parser.add_argument('--sessions', type=int, default=50, help='Number of sessions the events are spread over')
+    parser.add_argument('--flush-interval', type=float, default=0.002, help='Flush interval of the coalescing writer, in seconds')
+
+  def handle(self, *args, **options):
+    self.events = options['events']
+    self.sessions = [f'bench{i}' for i in range(options['sessions'])]
+    self.flush_interval = options['flush_interval']
+
+    self.redis = get_redis_connection('default')
+    # Open the connection up front, so the handshake is not counted
+    self.redis.ping()
+
+    self.stdout.write(f'{self.events} events over {len(self.sessions)} sessions\n')
+    self.report('unpipelined (before)', self.run_unpipelined)
+    self.report('EventHistoryWriter', self.run_writer)
+    self.report('AsyncEventHistoryWriter', lambda: asyncio.run(self.run_async_writer(None)))
+    self.report(f'AsyncEventHistoryWriter, {self.flush_interval * 1000:g}ms flush', lambda: asyncio.run(self.run_async_writer(self.flush_interval)))
+
+    self.cleanup()
+
+  def report(self, name, run):
+    self.cleanup()
+
+    with count_round_trips() as counter:
+      start = time.perf_counter()
+      run()
+      elapsed = time.perf_counter() - start
+
+    self.stdout.write(
+      f'{name:<45} {counter["round_trips"] / self.events:6.3f} round trips/event'
+      f'  {elapsed / self.events * 1e6:8.1f} us/event'
+    )
+
+  def payloads(self):
+    for idx in range(self.events):
+      session_id = self.sessions[idx % len(self.sessions)]
+      yield session_id, json.dumps({
+        'session_id': session_id,
+        'client_type': 'bench',
+        'event_type': 'progress',
+        'data': {'progress': idx},
+        'date': ''
+      })
+
+  def run_unpipelined(self):
+    # What push_event and the consumers did before: list commands on the raw
+    # connection and only the log append on the pipeline
+    for session_id, payload in self.payloads():
+      pipeline = self.redis.pipeline()
+      self.redis.lpush(history_key(session_id), payload)
+      self.redis.ltrim(history_key(session_id), 0, HISTORY_LENGTH - 1)
+      pipeline.xadd(log_key(session_id), {'event': payload}, maxlen=LOG_LENGTH, approximate=True)
+      pipeline.execute()
+
+  def run_writer(self):
+    writer = EventHistoryWriter(self.redis)
+
+    for session_id, payload in self.payloads():
+      writer.write(session_id, payload)
+
+  async def run_async_writer(self, flush_interval):
+    client = aioredis.from_url(settings.CACHES['default']['LOCATION'])
+    writer = AsyncEventHistoryWriter(client, flush_interval=flush_interval)
+
+    # Every session writes its events one after another, like a busy consumer
+    async def session_writer(session_id, payloads):
+      for payload in payloads:
+        await writer.write(session_id, payload)
+
+    per_session = {}
+    for session_id, payload in self.payloads():
+      per_session.setdefault(session_id, []).append(payload)
+
+    await asyncio.gather(*[session_writer(s, p) for s, p in per_session.items()])
+    await client.close()
+
+  def cleanup(self):
+    self.redis.delete(*[history_key(s) for s in self.sessions], *[log_key(s) for s in self.sessions])
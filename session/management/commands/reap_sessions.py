@@ -0,0 +1,33 @@
+import time
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from session.reaper import reap_sessions
+
+
+class Command(BaseCommand):
+  help = 'Deletes unclaimed sessions that are older than a day, with their settings, queue and Redis keys'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--max-age', type=float, default=24, help='Age in hours after which unclaimed sessions are deleted')
+    parser.add_argument('--batch-size', type=int, default=500, help='Number of sessions deleted per transaction')
+    parser.add_argument('--interval', type=float, default=None, help='Keep reaping every this many seconds instead of reaping once')
+
+  def handle(self, *args, **options):
+    interval = options['interval']
+
+    while True:
+      removed = reap_sessions(datetime.timedelta(hours=options['max_age']), options['batch_size'])
+
+      if removed['sessions'] > 0 or interval is None:
+        self.stdout.write(
+          f'Removed {removed["sessions"]} sessions, {removed["settings"]} settings, '
+          f'{removed["queue"]} queued songs, {removed["currently_playing"]} playing songs '
+          f'and {removed["redis_keys"]} Redis keys'
+        )
+
+      if interval is None:
+        break
+
+      time.sleep(interval)
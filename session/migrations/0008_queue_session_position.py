@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('session', '0007_queue'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='queue',
+            index=models.Index(fields=['session', 'position'], name='session_que_session_9a74b8_idx'),
+        ),
+    ]
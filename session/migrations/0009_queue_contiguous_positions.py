@@ -0,0 +1,34 @@
+# Generated by Django 4.1.4 on 2026-10-18 10:05
+
+from django.db import migrations
+
+
+def close_position_gaps(apps, schema_editor):
+    Queue = apps.get_model('session', 'Queue')
+
+    # Older versions of set_currently_playing left gaps, the queue operations expect 0..n-1
+    changed = []
+    session_id, position = None, 0
+
+    for queue in Queue.objects.only('id', 'session_id', 'position').order_by('session_id', 'position', 'id').iterator(chunk_size=2000):
+        if queue.session_id != session_id:
+            session_id, position = queue.session_id, 0
+
+        if queue.position != position:
+            queue.position = position
+            changed.append(queue)
+
+        position += 1
+
+    Queue.objects.bulk_update(changed, ['position'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('session', '0008_queue_session_position'),
+    ]
+
+    operations = [
+        migrations.RunPython(close_position_gaps, migrations.RunPython.noop),
+    ]
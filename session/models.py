@@ -1,28 +1,34 @@
 import json
 
-from django.db import models
-from django.utils.crypto import get_random_string
+from django.db import models, transaction, IntegrityError
 
+from session.allocator import session_id_pool
+from session.catalog import event_catalog, get_allowed_event_ids
+
+from tawa3.serializers import register, isoformat
 from user.models import User
 from playlist.models import Playlist, Song
+from playlist.counters import annotate_play_counts
 
 class SessionManager(models.Manager):
 
-  allowed_chars = 'ABCDEFGHIJKLNOPQRSTUVXYZ'
-
-  # Generate random session_id that does not exist in the database yet
+  # Take a random session_id that does not exist in the database yet from the pool
   def create(self, **obj_data):
-    session_id = get_random_string(length=4, allowed_chars=self.allowed_chars)
-    
-    # Check if session_id already exists in the database
-    while self.filter(session_id=session_id).exists():
-      # If it does, generate a new one
-      session_id = get_random_string(length=4, allowed_chars=self.allowed_chars)
-    
-    # Set the session_id to the object data
-    obj_data['session_id'] = session_id
-    # Create the object
-    return super().create(**obj_data)
+    while True:
+      # Set the session_id to the object data
+      obj_data['session_id'] = session_id_pool.allocate(lambda: self.values_list('session_id', flat=True))
+
+      try:
+        # Create the object
+        with transaction.atomic():
+          return super().create(**obj_data)
+      except IntegrityError:
+        if not self.filter(session_id=obj_data['session_id']).exists():
+          raise
+
+        # The pool handed out an id that is in use after all (it was filled while a
+        # session was being created), that id stays out of the pool so take another one
+        continue
 
 
 class Session(models.Model):
@@ -40,7 +46,7 @@ class Session(models.Model):
     return {
       'session_id': self.session_id,
       'user': (self.user.toJSON() if recursive else self.user.username) if self.user else None,
-      'playlist_id': self.playlist.id if self.playlist else None,
+      'playlist_id': self.playlist_id,
       'created_at': self.created_at.isoformat(),
       'updated_at': self.updated_at.isoformat(),
       'claimed': self.claimed
@@ -102,7 +108,7 @@ class SessionSettings(models.Model):
       'youtube_only_audio': self.youtube_only_audio,
       'allow_events': self.allow_events,
       'event_frequency': self.event_frequency,
-      'allowed_events': [x.toJSON() for x in self.allowed_events.all()],
+      'allowed_events': [x.toJSON() for x in event_catalog.get_by_ids(get_allowed_event_ids(self))],
       'random_word_list': self.random_word_list,
       'anyone_can_use_player_controls': self.anyone_can_use_player_controls,
       'anyone_can_add_to_queue': self.anyone_can_add_to_queue,
@@ -157,9 +163,43 @@ class Queue(models.Model):
   song = models.ForeignKey(Song, on_delete=models.CASCADE)
   position = models.IntegerField(default=0)
 
+  class Meta:
+    indexes = [
+      models.Index(fields=['session', 'position']),
+    ]
+
   def toJSON(self, recursive=True):
     return {
       'session': self.session.session_id,
       'song': self.song.toJSON() if recursive else self.song.id,
       'position': self.position
-    }
\ No newline at end of file
+    }
+
+
+register(Session,
+  select_related=['user'],
+  small_select_related=['user'],
+  columns={
+    'session_id': 'session_id',
+    'playlist_id': 'playlist_id',
+    'created_at': ('created_at', isoformat),
+    'updated_at': ('updated_at', isoformat),
+    'claimed': 'claimed',
+  })
+def prepare_song_entries(entries, recursive):
+  # Queue and CurrentlyPlaying serialize their song
+  if recursive:
+    annotate_play_counts(entry.song for entry in entries)
+
+
+register(SessionSettings, select_related=['session__user'], small_select_related=['session'])
+register(Spotify, select_related=['user'], small_select_related=['user'])
+register(CurrentlyPlaying, select_related=['song__added_by', 'session__user'], small_select_related=['song', 'session'], prepare=prepare_song_entries)
+register(Queue,
+  select_related=['session', 'song__added_by'],
+  small_select_related=['session', 'song'],
+  prepare=prepare_song_entries,
+  columns={
+    'session': 'session__session_id',
+    'position': 'position',
+  })
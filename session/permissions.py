@@ -0,0 +1,64 @@
+import json
+
+from django.conf import settings
+
+from session.models import SessionSettings
+from session.state import state_key, refresh_state
+
+
+# event type -> the SessionSettings permission a client needs to send it, when it is
+# not the owner of the session. Event types that are not listed can be sent by anyone
+EVENT_PERMISSIONS = getattr(settings, 'SESSION_EVENT_PERMISSIONS', {})
+
+
+def read_settings(redis, session_id):
+  """
+    The settings from the session snapshot, rebuilt from the database when the snapshot
+    is missing. None for a session that has no settings (it is not claimed yet)
+  """
+  stored = redis.hget(state_key(session_id), 'settings')
+
+  if stored is not None:
+    return json.loads(stored)
+
+  try:
+    return refresh_state(redis, session_id, 'settings')['settings']
+  except SessionSettings.DoesNotExist:
+    return None
+
+
+async def async_read_settings(redis, session_id, rebuild):
+  """
+    Same as read_settings on the async Redis client, `rebuild(session_id)` is awaited
+    when the snapshot is missing
+  """
+  stored = await redis.hget(state_key(session_id), 'settings')
+
+  if stored is not None:
+    return json.loads(stored)
+
+  return await rebuild(session_id)
+
+
+def is_owner(session_settings, user):
+  owner = (session_settings.get('session') or {}).get('user')
+
+  return user.is_authenticated and owner is not None and owner['id'] == user.id
+
+
+def allows_connect(session_settings, user):
+  if session_settings is None or user.is_authenticated:
+    return True
+
+  return session_settings.get('allow_guests', True)
+
+
+def needs_permission(event_type):
+  return isinstance(event_type, str) and event_type in EVENT_PERMISSIONS
+
+
+def allows_event(session_settings, user, event_type):
+  if session_settings is None or not needs_permission(event_type) or is_owner(session_settings, user):
+    return True
+
+  return session_settings.get(EVENT_PERMISSIONS[event_type], True)
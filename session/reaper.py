@@ -0,0 +1,75 @@
+import datetime
+from collections import Counter
+
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from session.models import Session, SessionSettings, Queue, CurrentlyPlaying
+from session.events import history_key, log_key
+from session.state import state_key
+from session.algorithms import played_key, round_robin_key
+from session.shuffle import order_key, cursor_key, removed_key
+from session.catalog import allowed_events_key
+
+redis = get_redis_connection('default')
+
+
+def session_keys(session_id):
+  """
+    All Redis keys that belong to a session
+  """
+  return [
+    history_key(session_id),
+    log_key(session_id),
+    state_key(session_id),
+    played_key(session_id),
+    round_robin_key(session_id),
+    order_key(session_id),
+    cursor_key(session_id),
+    removed_key(session_id),
+  ]
+
+
+def delete_session_keys(session_ids):
+  keys = [key for session_id in session_ids for key in session_keys(session_id)]
+
+  if len(keys) == 0:
+    return 0
+
+  return redis.delete(*keys)
+
+
+def reap_sessions(max_age=datetime.timedelta(days=1), batch_size=500):
+  """
+    Deletes unclaimed sessions older than `max_age` in batches of `batch_size`. The rows
+    of every batch are removed with one DELETE per table instead of going through the
+    cascade collector per session. Returns the number of removed rows and Redis keys
+  """
+  cutoff = timezone.now() - max_age
+  removed = Counter()
+
+  while True:
+    with transaction.atomic():
+      # Locked until the batch is deleted, a session that is claimed meanwhile waits for the
+      # reaper and one claimed before the lock is not selected
+      batch = list(
+        Session.objects.select_for_update().filter(claimed=False, created_at__lt=cutoff).order_by('id').values_list('id', 'session_id')[:batch_size]
+      )
+
+      if len(batch) == 0:
+        break
+
+      ids = [id for id, _ in batch]
+      session_ids = [session_id for _, session_id in batch]
+
+      removed['queue'] += Queue.objects.filter(session_id__in=ids).delete()[0]
+      removed['currently_playing'] += CurrentlyPlaying.objects.filter(session_id__in=ids).delete()[0]
+      SessionSettings.allowed_events.through.objects.filter(sessionsettings_id__in=ids).delete()
+      removed['settings'] += SessionSettings.objects.filter(session_id__in=ids).delete()[0]
+      removed['sessions'] += Session.objects.filter(id__in=ids, claimed=False).delete()[1].get('session.Session', 0)
+
+    removed['redis_keys'] += delete_session_keys(session_ids)
+    removed['redis_keys'] += redis.delete(*[allowed_events_key(id) for id in ids])
+
+  return removed
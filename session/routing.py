@@ -1,7 +1,7 @@
 from django.urls import re_path
 
-from session.consumers import SessionConsumer
+from session.consumers import AsyncSessionConsumer
 
 websocket_urlpatterns = [
-    re_path(r"ws/session/(?P<session_id>\w+)/$", SessionConsumer.as_asgi()),
-]
\ No newline at end of file
+    re_path(r"ws/session/(?P<session_id>\w+)/$", AsyncSessionConsumer.as_asgi()),
+]
@@ -0,0 +1,185 @@
+import random
+import struct
+import threading
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from playlist.models import Playlist, Song
+from playlist.signals import songs_bulk_added
+from session.models import Session
+
+redis = get_redis_connection('default')
+
+
+# The shuffle of a session is cleaned up with the session
+SHUFFLE_TTL = 60 * 60 * 24
+
+# Song ids are packed as little endian 64 bit integers
+SONG_ID = struct.Struct('<q')
+
+
+def order_key(session_id):
+  return f'session::{session_id}::shuffle'
+
+
+def cursor_key(session_id):
+  return f'session::{session_id}::shuffle::cursor'
+
+
+def removed_key(session_id):
+  return f'session::{session_id}::shuffle::removed'
+
+
+def reshuffle(session_id, playlist_id):
+  """
+    Stores a new seeded permutation of all songs of the playlist as a packed array
+    and resets the cursor to its start
+  """
+  ids = list(Song.objects.filter(playlist_id=playlist_id).order_by('id').values_list('id', flat=True))
+
+  seed = random.getrandbits(32)
+  random.Random(seed).shuffle(ids)
+
+  pipeline = redis.pipeline(transaction=True)
+  pipeline.set(order_key(session_id), struct.pack(f'<{len(ids)}q', *ids), ex=SHUFFLE_TTL)
+  pipeline.delete(cursor_key(session_id), removed_key(session_id))
+  pipeline.hset(cursor_key(session_id), mapping={'offset': 0, 'seed': seed, 'playlist_id': playlist_id})
+  pipeline.expire(cursor_key(session_id), SHUFFLE_TTL)
+  pipeline.execute()
+
+  return len(ids)
+
+
+def next_songs(session_id, playlist_id, count):
+  """
+    Returns the next `count` song ids of the shuffle. The cursor is advanced atomically,
+    so concurrent callers never get the same slots, and only those slots are read, a
+    call costs O(count) no matter how large the playlist is. Songs that were deleted
+    from the playlist are skipped and a new permutation is started once every song
+    has been played. Returns fewer songs only when the playlist is too small
+  """
+  ids = []
+  reshuffled = False
+
+  while len(ids) < count:
+    wanted = count - len(ids)
+    end = redis.hincrby(cursor_key(session_id), 'offset', wanted)
+    packed = redis.getrange(order_key(session_id), (end - wanted) * SONG_ID.size, end * SONG_ID.size - 1)
+    slots = [packed[i:i + SONG_ID.size] for i in range(0, len(packed) - SONG_ID.size + 1, SONG_ID.size)]
+
+    if len(slots) > 0:
+      pipeline = redis.pipeline(transaction=False)
+      for slot in slots:
+        pipeline.srem(removed_key(session_id), slot)
+
+      ids += [SONG_ID.unpack(slot)[0] for slot, removed in zip(slots, pipeline.execute()) if not removed]
+
+    if len(slots) < wanted:
+      # Every song has been played (or there is no shuffle yet), start over
+      if reshuffled:
+        break
+
+      reshuffle(session_id, playlist_id)
+      reshuffled = True
+
+  return ids
+
+
+def next_song(session_id, playlist_id):
+  """
+    Returns the next song id of the shuffle, None for an empty playlist
+  """
+  ids = next_songs(session_id, playlist_id, 1)
+
+  return ids[0] if len(ids) > 0 else None
+
+
+def add_song(session_id, song_id):
+  """
+    Puts a song that was added to the playlist at a random position among the songs
+    that have not been played yet: it is appended and swapped with a random unplayed
+    slot, like one step of a Fisher-Yates shuffle, so nothing else is reshuffled
+  """
+  with redis.pipeline() as pipeline:
+    while True:
+      try:
+        pipeline.watch(order_key(session_id), cursor_key(session_id))
+
+        if not pipeline.exists(order_key(session_id)):
+          return
+
+        length = pipeline.strlen(order_key(session_id)) // SONG_ID.size
+        offset = min(int(pipeline.hget(cursor_key(session_id), 'offset') or 0), length)
+        slot = random.randint(offset, length)
+
+        packed = SONG_ID.pack(song_id)
+        if slot < length:
+          moved = pipeline.getrange(order_key(session_id), slot * SONG_ID.size, (slot + 1) * SONG_ID.size - 1)
+
+        pipeline.multi()
+        if slot < length:
+          pipeline.setrange(order_key(session_id), slot * SONG_ID.size, packed)
+          pipeline.append(order_key(session_id), moved)
+        else:
+          pipeline.append(order_key(session_id), packed)
+        pipeline.execute()
+        return
+      except WatchError:
+        continue
+
+
+def remove_song(session_id, song_id):
+  """
+    Marks a song that was deleted from the playlist, next_song skips it when its slot comes up
+  """
+  pipeline = redis.pipeline(transaction=True)
+  pipeline.sadd(removed_key(session_id), SONG_ID.pack(song_id))
+  pipeline.expire(removed_key(session_id), SHUFFLE_TTL)
+  pipeline.execute()
+
+
+def shuffled_sessions(playlist_id):
+  return Session.objects.filter(playlist_id=playlist_id, claimed=True).values_list('session_id', flat=True)
+
+
+@receiver(post_save, sender=Song)
+def add_song_to_shuffles(sender, instance, created, **kwargs):
+  if created:
+    for session_id in shuffled_sessions(instance.playlist_id):
+      add_song(session_id, instance.id)
+
+
+# delete() sends post_delete per song, the sessions are looked up once per delete() call
+deleting = threading.local()
+
+
+def sessions_for_delete(origin, playlist_id):
+  cache = getattr(deleting, 'sessions', None)
+
+  if cache is None or cache[0] is not origin:
+    cache = deleting.sessions = (origin, {})
+
+  if playlist_id not in cache[1]:
+    cache[1][playlist_id] = list(shuffled_sessions(playlist_id))
+
+  return cache[1][playlist_id]
+
+
+@receiver(post_delete, sender=Song)
+def remove_song_from_shuffles(sender, instance, origin=None, **kwargs):
+  # The sessions of a deleted playlist are deleted with it
+  if isinstance(origin, Playlist):
+    return
+
+  for session_id in sessions_for_delete(origin, instance.playlist_id):
+    remove_song(session_id, instance.id)
+
+
+@receiver(songs_bulk_added)
+def add_songs_to_shuffles(sender, playlist_id, song_ids, **kwargs):
+  for session_id in shuffled_sessions(playlist_id):
+    for song_id in song_ids:
+      add_song(session_id, song_id)
@@ -0,0 +1,74 @@
+import json
+
+from tawa3.tools import J
+from tawa3.serializers import optimized
+
+from session.models import SessionSettings, CurrentlyPlaying, Queue
+
+
+# The snapshot of a session lives as long as an unclaimed session, every update refreshes it
+STATE_TTL = 60 * 60 * 24
+
+STATE_PARTS = ('settings', 'currently_playing', 'queue')
+
+
+def state_key(session_id):
+  return f'session::{session_id}::state'
+
+
+def build_settings(session_id):
+  return J(optimized(SessionSettings.objects).get(session__session_id=session_id))
+
+
+def build_currently_playing(session_id):
+  playing = optimized(CurrentlyPlaying.objects).filter(session__session_id=session_id).first()
+
+  return J(playing) if playing else None
+
+
+def build_queue(session_id):
+  return J(Queue.objects.filter(session__session_id=session_id).order_by('position'))
+
+
+BUILDERS = {
+  'settings': build_settings,
+  'currently_playing': build_currently_playing,
+  'queue': build_queue,
+}
+
+
+def store_state(redis, session_id, **parts):
+  """
+    Stores already serialized parts of the session snapshot (settings, currently_playing
+    and/or queue), the parts that are not given are left as they are
+  """
+  pipeline = redis.pipeline(transaction=True)
+  pipeline.hset(state_key(session_id), mapping={name: json.dumps(value) for name, value in parts.items()})
+  pipeline.expire(state_key(session_id), STATE_TTL)
+  pipeline.execute()
+
+
+def refresh_state(redis, session_id, *names):
+  """
+    Rebuilds parts of the session snapshot from the database, all parts if none are given
+  """
+  parts = {name: BUILDERS[name](session_id) for name in (names or STATE_PARTS)}
+  store_state(redis, session_id, **parts)
+
+  return parts
+
+
+def read_state(redis, session_id):
+  """
+    Returns the session snapshot from Redis, only a missing or incomplete snapshot
+    (expired, or created before snapshots existed) is rebuilt from the database
+  """
+  stored = redis.hgetall(state_key(session_id))
+  state = {name.decode('utf-8'): json.loads(value) for name, value in stored.items()}
+
+  missing = [name for name in STATE_PARTS if name not in state]
+
+  if len(missing) > 0:
+    state.update(refresh_state(redis, session_id, *missing))
+
+  return state
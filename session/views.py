@@ -1,9 +1,9 @@
 import datetime
 import traceback
-import pytz
 import json
 
 from django.db import transaction
+from django.db.models import F, Max
 from django.core import serializers
 
 from dateutil import parser
@@ -12,25 +12,46 @@ from modernrpc.core import rpc_method
 from modernrpc.auth import set_authentication_predicate
 
 from tawa3.tools import is_authenticated, is_staff, J
-from session.models import KokopelliEvent, Session, Queue, SessionSettings, Spotify, CurrentlyPlaying
+from tawa3.serializers import optimized
+from session.codecs import encode_stored_event, decode_stored_event
+from session.events import HISTORY_LENGTH, EventHistoryWriter, history_key, read_log_since, is_event_id
+from session.state import store_state, refresh_state, read_state
+from session.algorithms import generate, mark_played
+from session.shuffle import next_song
+from session.reaper import delete_session_keys
+from session.catalog import event_catalog, allowed_events_key
+from session.models import Session, Queue, SessionSettings, Spotify, CurrentlyPlaying
 from playlist.models import Song
+from playlist.counters import increment_play_count
 
 from django_redis import get_redis_connection
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
 redis = get_redis_connection('default')
+event_writer = EventHistoryWriter(redis)
 
 
 @rpc_method
 @set_authentication_predicate(is_authenticated)
-def get_event_history(session_id, **kwargs):
-  event_cache = redis.lrange('session::' + session_id, 0, 99)
+def get_event_history(session_id, since=None, **kwargs):
+  """
+    Returns the last 100 events of the session, newest first. When `since` is given
+    only the events after that event id are returned, oldest first, so a reconnecting
+    client can catch up without downloading the whole history again
+  """
+  if since is not None:
+    if not is_event_id(since):
+      raise Exception('Invalid event id: ' + str(since))
+
+    return read_log_since(redis, session_id, since)
+
+  event_cache = redis.lrange(history_key(session_id), 0, HISTORY_LENGTH - 1)
 
   events = []
 
   for event in event_cache:
-    events.append(json.loads(event.decode('utf-8')))
+    events.append(decode_stored_event(event))
   
   return events
 
@@ -47,13 +68,9 @@ def push_event(session_id, client_type, event_type, data, **kwargs):
     'session_id': session_id
   }
 
-  pipeline = redis.pipeline()
-  # Push the event to the list
-  redis.lpush(f'session::{session_id}', json.dumps(event))
-  # Trim the list to 100 elements
-  redis.ltrim(f'session::{session_id}', 0, 99)
-  # Execute the pipeline!
-  pipeline.execute()
+  # Store the event in the history list and the resumable log, clients
+  # remember the id of the last event they saw to resume from it
+  event['id'] = event_writer.write(session_id, encode_stored_event(event))
 
   channel_layer = get_channel_layer()
 
@@ -64,48 +81,47 @@ def push_event(session_id, client_type, event_type, data, **kwargs):
   )
 
   return {
-    'success': True
+    'success': True,
+    'id': event['id']
   }
 
 
 @rpc_method
 @set_authentication_predicate(is_authenticated)
 def get_session(session_id, **kwargs):
-  settings = SessionSettings.objects.get(session__session_id=session_id)
+  settings = optimized(SessionSettings.objects).get(session__session_id=session_id)
 
   return J(settings)
 
 
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def get_session_state(session_id, **kwargs):
+  """
+    Returns everything a client needs to open a session in one call: the settings,
+    the currently playing song and the ordered queue. Served from the snapshot in
+    Redis that claim_session, set_currently_playing and set_queue keep up to date
+  """
+  return read_state(redis, session_id)
+
+
 @rpc_method
 @set_authentication_predicate(is_staff)
-def get_sessions(**kwargs):
-  return [J(x) for x in Session.objects.all()]
+def get_sessions(fields=None, **kwargs):
+  return J(Session.objects.all(), fields=fields)
 
 
 @rpc_method
 @set_authentication_predicate(is_authenticated)
 def get_session_settings(session_id, **kwargs):
-  return J(SessionSettings.objects.get(session_id=session_id))
-
-
-def delete_old_sessions():
-  one_day_ago = datetime.datetime.now() - datetime.timedelta(days=1)
-  one_day_ago = one_day_ago.replace(tzinfo=pytz.UTC)
-
-  old_sessions = Session.objects.filter(claimed=False, created_at__lt=one_day_ago).all()
-
-  if len(old_sessions) > 0:
-    for s in old_sessions:
-      s.delete()
+  return J(optimized(SessionSettings.objects).get(session_id=session_id))
 
 
 @rpc_method
 def create_temp_session(**kwargs):
+  # Old sessions that are never claimed are deleted by the reap_sessions command
   session = Session.objects.create()
 
-  # Check if there are any old sessions that are not claimed
-  delete_old_sessions()
-
   return J(session)
   
 
@@ -119,8 +135,8 @@ def claim_session(playlist_id, session_id, settings, **kwargs):
     user = kwargs['request'].user
     token = kwargs['request'].access_token
 
-    # first check if the session is already claimed
-    session = Session.objects.get(session_id=session_id)
+    # first check if the session is already claimed, locked so the reaper cannot delete it meanwhile
+    session = Session.objects.select_for_update().get(session_id=session_id)
 
     if session.claimed == True:
       raise Exception('Session already claimed')
@@ -129,9 +145,15 @@ def claim_session(playlist_id, session_id, settings, **kwargs):
     old_session = Session.objects.filter(user=user).all()
 
     if len(old_session) > 0:
+      # delete() clears the pks, the settings are keyed by the pk of their session
+      old_session_ids = [s.session_id for s in old_session]
+      old_settings_keys = [allowed_events_key(s.id) for s in old_session]
+
       for s in old_session:
         s.delete()
 
+      transaction.on_commit(lambda: delete_session_keys(old_session_ids) + redis.delete(*old_settings_keys))
+
     # Claim the session
 
     session.playlist_id = playlist_id
@@ -145,17 +167,21 @@ def claim_session(playlist_id, session_id, settings, **kwargs):
     allowed_events = []
     for e in a:
       name = e['name']
-      event = KokopelliEvent.objects.filter(name=name)
+      event = event_catalog.get(name)
 
-      if (len(event) == 0):
+      if event is None:
         raise Exception('Event not found: ' + name)
 
-      allowed_events.append(event[0])
+      allowed_events.append(event)
 
     session_settings = SessionSettings.objects.create(session=session, **settings)
     session_settings.allowed_events.set(allowed_events)
     session_settings.save()
 
+    # A freshly claimed session has nothing playing and an empty queue
+    state = {'settings': J(session_settings), 'currently_playing': None, 'queue': []}
+    transaction.on_commit(lambda: store_state(redis, session.session_id, **state))
+
     # Everything went right! Now notify the webplayer that the session has been claimed
 
     spotify = Spotify.objects.get(user=user)
@@ -262,15 +288,22 @@ def set_currently_playing(song_id, session_id, **kwargs):
 
     currenty_playing = CurrentlyPlaying.objects.create(song=song, session=session)
 
-    # Then, increment the play count for this song
-    song.play_count += 1
-    song.save()
+    # Then, increment the play count for this song, the counter is flushed to the database later
+    increment_play_count(song.id)
 
-    # Remove the song from the queue
-    queue = Queue.objects.filter(session=session, song=song).first()
+    # Remove the song from the queue and close the gap it leaves
+    queue = Queue.objects.filter(session=session, song=song).order_by('position').first()
 
     if queue is not None:
       queue.delete()
+      Queue.objects.filter(session=session, position__gt=queue.position).update(position=F('position') - 1)
+
+    # Update the snapshot and the play history once the new song is committed
+    playing = J(currenty_playing)
+    transaction.on_commit(lambda: store_state(redis, session.session_id, currently_playing=playing))
+    transaction.on_commit(lambda: mark_played(session.session_id, song.id))
+    if queue is not None:
+      transaction.on_commit(lambda: refresh_state(redis, session.session_id, 'queue'))
 
     # Notify all clients that a new song is playing
     push_event(session.session_id, 'tawa', 'play_song', {
@@ -283,40 +316,223 @@ def set_currently_playing(song_id, session_id, **kwargs):
 @rpc_method
 @set_authentication_predicate(is_authenticated)
 def get_currently_playing(session_id, **kwargs):
-  p = CurrentlyPlaying.objects.get(session__session_id=session_id)
+  p = optimized(CurrentlyPlaying.objects).get(session__session_id=session_id)
 
   return J(p)
 
 
+def get_songs(ids):
+  """
+    Fetches the songs for a list of song ids (numbers or numeric strings) in a single query,
+    in the order of the ids. Raises if any of them does not exist
+  """
+  if type(ids) is not list:
+    raise Exception('ids must be an array')
+
+  try:
+    ids = [int(id) for id in ids]
+  except (TypeError, ValueError):
+    raise Exception('Song ids must be numbers')
+
+  songs = Song.objects.select_related('added_by').in_bulk(ids)
+  missing = [id for id in ids if id not in songs]
+
+  if len(missing) > 0:
+    raise Exception('Songs not found: ' + ', '.join(str(id) for id in missing))
+
+  return [songs[id] for id in ids]
+
+
+def get_queue_position(session, position, length=None):
+  if type(position) is not int:
+    raise Exception('Position must be a number')
+
+  if length is None:
+    length = Queue.objects.filter(session=session).count()
+
+  if position < 0 or position >= length:
+    raise Exception('Position out of range: ' + str(position))
+
+  return position
+
+
+def push_queue_diff(session, op, **diff):
+  """
+    Refreshes the queue in the session snapshot and sends a small queue_diff
+    event once the queue change is committed, instead of the whole queue
+  """
+  def notify():
+    refresh_state(redis, session.session_id, 'queue')
+    push_event(session.session_id, 'tawa', 'queue_diff', {'op': op, **diff})
+
+  transaction.on_commit(notify)
+
+
 @rpc_method
 @set_authentication_predicate(is_authenticated)
 def set_queue(ids, session_id):
   with transaction.atomic():
-    session = Session.objects.get(session_id=session_id)
+    # Same lock as the queue_* operations, so they do not interleave
+    session = Session.objects.select_for_update().get(session_id=session_id)
 
-    if type(ids) is not list:
-      raise Exception('ids must be an array')
+    # Check if all songs exist
+    songs = get_songs(ids)
 
     # Delete all songs in the queue for this session
     Queue.objects.filter(session=session).delete()
 
-    q = []
+    q = Queue.objects.bulk_create([
+      Queue(song=song, session=session, position=idx) for idx, song in enumerate(songs)
+    ])
 
-    for idx, id in enumerate(ids):
-      # Check if all songs exist
-      song = Song.objects.get(id=id)
-      # Create the queue object
-      queue = Queue.objects.create(song=song, session=session, position=idx)
-      q.append(queue)
+    serialized = J(q)
+    transaction.on_commit(lambda: store_state(redis, session.session_id, queue=serialized))
 
     return {
-      'queue': [J(queue) for queue in q]
+      'queue': serialized
     }
 
 
 @rpc_method
 @set_authentication_predicate(is_authenticated)
-def get_queue(session_id, **kwargs):
-  queue = Queue.objects.filter(session__session_id=session_id).order_by('position').all()
+def queue_insert(session_id, song_id, position=None):
+  """
+    Inserts a song into the queue at `position`, or at the end when no position is given
+  """
+  with transaction.atomic():
+    session = Session.objects.select_for_update().get(session_id=session_id)
+    song = get_songs([song_id])[0]
+    length = Queue.objects.filter(session=session).count()
+
+    if position is None:
+      position = length
+    elif position != length:
+      position = get_queue_position(session, position, length)
+
+    # Make room for the new song
+    Queue.objects.filter(session=session, position__gte=position).update(position=F('position') + 1)
+    queue = Queue.objects.create(song=song, session=session, position=position)
+
+    push_queue_diff(session, 'insert', position=position, song=J(song))
+
+    return J(queue)
 
-  return [J(q) for q in queue]
\ No newline at end of file
+
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def queue_move(session_id, from_position, to_position):
+  """
+    Moves the song at `from_position` to `to_position`, the songs in between shift one place
+  """
+  with transaction.atomic():
+    session = Session.objects.select_for_update().get(session_id=session_id)
+    length = Queue.objects.filter(session=session).count()
+    from_position = get_queue_position(session, from_position, length)
+    to_position = get_queue_position(session, to_position, length)
+
+    queue = Queue.objects.filter(session=session, position=from_position).first()
+
+    # A cascade left a gap that is not closed yet
+    if queue is None:
+      raise Exception('Position out of range: ' + str(from_position))
+
+    if from_position < to_position:
+      Queue.objects.filter(session=session, position__gt=from_position, position__lte=to_position).update(position=F('position') - 1)
+    elif from_position > to_position:
+      Queue.objects.filter(session=session, position__gte=to_position, position__lt=from_position).update(position=F('position') + 1)
+
+    queue.position = to_position
+    queue.save(update_fields=['position'])
+
+    push_queue_diff(session, 'move', from_position=from_position, to_position=to_position)
+
+    return True
+
+
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def queue_remove(session_id, position):
+  """
+    Removes the song at `position` from the queue, the songs after it shift one place up
+  """
+  with transaction.atomic():
+    session = Session.objects.select_for_update().get(session_id=session_id)
+    position = get_queue_position(session, position)
+
+    deleted, _ = Queue.objects.filter(session=session, position=position).delete()
+
+    if deleted == 0:
+      raise Exception('Position out of range: ' + str(position))
+
+    Queue.objects.filter(session=session, position__gt=position).update(position=F('position') - 1)
+
+    push_queue_diff(session, 'remove', position=position)
+
+    return True
+
+
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def queue_append_many(session_id, ids):
+  """
+    Appends a list of songs to the end of the queue
+  """
+  with transaction.atomic():
+    session = Session.objects.select_for_update().get(session_id=session_id)
+    songs = get_songs(ids)
+
+    last = Queue.objects.filter(session=session).aggregate(last=Max('position'))['last']
+    start = last + 1 if last is not None else 0
+
+    q = Queue.objects.bulk_create([
+      Queue(song=song, session=session, position=start + idx) for idx, song in enumerate(songs)
+    ])
+
+    push_queue_diff(session, 'append', position=start, songs=J(songs))
+
+    return J(q)
+
+
+# Songs per generate_queue call
+MAX_GENERATED_SONGS = 100
+
+
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def generate_queue(session_id, count=10, **kwargs):
+  """
+    Picks the next `count` song ids for a session with the algorithm in its settings
+    (random, play_count, least_recently_played or round_robin). Songs that are queued
+    or playing are skipped, the session is read from its snapshot
+  """
+  state = read_state(redis, session_id)
+  settings = state['settings']
+
+  exclude = [q['song']['id'] for q in state['queue']]
+  if state['currently_playing'] is not None:
+    exclude.append(state['currently_playing']['song']['id'])
+
+  if type(count) is not int:
+    raise Exception('Count must be a number')
+
+  count = max(1, min(count, MAX_GENERATED_SONGS))
+
+  return generate(settings['algorithm_used'], settings['session']['playlist_id'], count, session_id, exclude)
+
+
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def get_next_shuffled_song(session_id, **kwargs):
+  """
+    Returns the id of the next song in the no-repeat shuffle of the session, songs only
+    repeat after every song of the playlist was handed out
+  """
+  settings = read_state(redis, session_id)['settings']
+
+  return next_song(session_id, settings['session']['playlist_id'])
+
+
+@rpc_method
+@set_authentication_predicate(is_authenticated)
+def get_queue(session_id, fields=None, **kwargs):
+  return J(Queue.objects.filter(session__session_id=session_id).order_by('position'), fields=fields)
\ No newline at end of file
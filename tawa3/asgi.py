@@ -9,7 +9,6 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from channels.routing import ProtocolTypeRouter
@@ -23,13 +22,12 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tawa3.settings.production')
 django_asgi_app = get_asgi_application()
 
 import session.routing
+from tawa3.middleware import TokenAuthMiddleware
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": URLRouter(session.routing.websocket_urlpatterns)
-    #AllowedHostsOriginValidator(
-        # TODO Auth
-        # AuthMiddlewareStack(
-        # )
-    #)
+    "websocket": TokenAuthMiddleware(
+        URLRouter(session.routing.websocket_urlpatterns)
+    )
+    # No AllowedHostsOriginValidator, the native clients do not send an Origin header
 })
\ No newline at end of file
@@ -1,32 +1,93 @@
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django.http import HttpResponseBadRequest
-from user.models import AccessToken
+from user.tokens import resolve_token, cached_token
+from session.codecs import TOKEN_SUBPROTOCOL_PREFIX
+
+
+def url_prefix(url):
+  return '/' + url.lstrip('/')
+
 
 class AccessTokenMiddleware:
 
   def __init__(self, get_response):
     self.get_response = get_response
 
+    # Paths that are served without an access token
+    self.skipped_prefixes = tuple(
+      url_prefix(url) for url in ['admin/', settings.MEDIA_URL, settings.STATIC_URL] if url
+    )
 
-  def __call__(self, request):
-    response = self.get_response(request)
 
+  def __call__(self, request):
+    # Checked before the view runs, a rejected RPC call must not do any work
     if request.method == 'POST' and (request.path == '/rpc' or request.path == '/rpc/'):
       client_type = request.META.get('HTTP_X_KOKOPELLI_CLIENT_TYPE', None)
 
       if not client_type:
         return HttpResponseBadRequest('X-Kokopelli-Client-Type header not specified')
 
-    return response
+    if not request.path.startswith(self.skipped_prefixes):
+      self.authenticate(request)
 
-  def process_view(self, request, view_func, *view_args, **view_kwargs):
+    return self.get_response(request)
+
+  def authenticate(self, request):
     bearer_token = request.META.get('HTTP_AUTHORIZATION', None)
 
     if bearer_token:
-      token_str = bearer_token.split(' ')[1]
+      parts = bearer_token.split(' ')
+
+      if len(parts) != 2 or parts[1] == '':
+        return
 
-      token_obj = AccessToken.objects.filter(token=token_str).first()
+      token_obj = resolve_token(parts[1])
 
       if token_obj:
         request.user = token_obj.user
         request.access_token = token_obj
 
+
+def websocket_token(scope):
+  """
+    The access token of a websocket connect, from the Authorization header or, for
+    browsers that cannot set headers on a websocket, the `kokopelli.token.<token>`
+    subprotocol. Not from the query string, URLs end up in access logs
+  """
+  for name, value in scope.get('headers', []):
+    if name == b'authorization':
+      parts = value.decode('latin1').split(' ')
+
+      if len(parts) == 2 and parts[1] != '':
+        return parts[1]
+
+  for subprotocol in scope.get('subprotocols', []):
+    if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+      return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):]
+
+  return None
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+  """
+    Sets scope['user'] (and scope['access_token']) of websocket connections from the same
+    access token the RPC uses, resolved through the token cache. Without a valid token
+    the user is anonymous
+  """
+
+  async def __call__(self, scope, receive, send):
+    scope = dict(scope)
+
+    token = websocket_token(scope)
+    access_token = None
+
+    if token:
+      access_token = cached_token(token) or await database_sync_to_async(resolve_token)(token)
+
+    scope['user'] = access_token.user if access_token else AnonymousUser()
+    scope['access_token'] = access_token
+
+    return await super().__call__(scope, receive, send)
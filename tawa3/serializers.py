@@ -0,0 +1,134 @@
+from django.db.models import Manager, QuerySet
+
+
+# model -> {recursive: (select_related, prefetch_related)}
+RELATED = {}
+
+# model -> {serialized key: (column, transform)}
+COLUMNS = {}
+
+# model -> function(objects, recursive) that loads what toJSON needs for all objects at once
+PREPARE = {}
+
+
+def register(model, select_related=(), prefetch_related=(), small_select_related=(), small_prefetch_related=(), columns=None, prepare=None):
+  """
+    Declares which related objects the toJSON of a model touches, for toJSON() and for
+    toJSON(recursive=False), so querysets that are serialized load them up front
+    instead of with one query per object.
+
+    `columns` maps the keys of toJSON that are a plain column (or a column of a
+    related object, as a values() lookup) to that column, optionally with a function
+    that turns the value into its serialized form: {'created_at': ('created_at', isoformat)}
+
+    `prepare(objects, recursive)` is called with all objects that are serialized together,
+    for data toJSON would otherwise fetch per object (like the play counts buffered in Redis)
+  """
+  RELATED[model] = {
+    True: (list(select_related), list(prefetch_related)),
+    False: (list(small_select_related), list(small_prefetch_related)),
+  }
+
+  COLUMNS[model] = {
+    key: column if isinstance(column, tuple) else (column, None) for key, column in (columns or {}).items()
+  }
+
+  if prepare is not None:
+    PREPARE[model] = prepare
+
+
+def isoformat(value):
+  return value.isoformat() if value is not None else None
+
+
+def optimized(queryset, recursive=True):
+  """
+    Applies the select_related and prefetch_related a model declared to a queryset (or manager)
+  """
+  if isinstance(queryset, Manager):
+    queryset = queryset.all()
+
+  select_related, prefetch_related = RELATED.get(queryset.model, {}).get(recursive, ([], []))
+
+  if len(select_related) > 0:
+    queryset = queryset.select_related(*select_related)
+
+  if len(prefetch_related) > 0:
+    queryset = queryset.prefetch_related(*prefetch_related)
+
+  return queryset
+
+
+def prepared(objects, recursive=True):
+  """
+    Runs the prepare function of the model of the objects, returns them as a list
+  """
+  objects = list(objects)
+
+  if len(objects) > 0 and type(objects[0]) in PREPARE:
+    PREPARE[type(objects[0])](objects, recursive)
+
+  return objects
+
+
+def pick(data, fields):
+  return {field: data[field] for field in fields if field in data}
+
+
+def serialize_columns(queryset, fields):
+  """
+    Serializes the requested keys straight from values(), only the columns behind them
+    are fetched and no model instances are created. Returns None if a key is not a
+    plain column, those need toJSON
+  """
+  columns = COLUMNS.get(queryset.model, {})
+
+  if not all(field in columns for field in fields):
+    return None
+
+  data = []
+
+  for row in queryset.values(*{columns[field][0] for field in fields}):
+    item = {}
+
+    for field in fields:
+      column, transform = columns[field]
+      item[field] = transform(row[column]) if transform else row[column]
+
+    data.append(item)
+
+  return data
+
+
+def serialize(obj, recursive=True, fields=None):
+  """
+    Serializes a model instance, or every object of a queryset (or list) with a constant number
+    of queries. With `fields` only those keys are returned, querysets then only fetch the columns they need
+  """
+  if fields is not None and type(fields) is not list:
+    raise Exception('fields must be an array')
+
+  if isinstance(obj, (QuerySet, Manager)):
+    if isinstance(obj, Manager):
+      obj = obj.all()
+
+    if fields is not None:
+      data = serialize_columns(obj, fields)
+
+      if data is not None:
+        return data
+
+    obj = optimized(obj, recursive)
+
+  if isinstance(obj, (QuerySet, list, tuple)):
+    if fields is not None:
+      return [pick(x.toJSON(recursive=recursive), fields) for x in prepared(obj, recursive)]
+
+    return [x.toJSON(recursive=recursive) for x in prepared(obj, recursive)]
+
+  prepared([obj], recursive)
+
+  if fields is not None:
+    return pick(obj.toJSON(recursive=recursive), fields)
+
+  return obj.toJSON(recursive=recursive)
@@ -199,4 +199,44 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Events from the websocket are written to Redis in batches every few
+# milliseconds, set to None to write every event on its own
+SESSION_EVENT_FLUSH_INTERVAL = 0.002
+
+# Format of the events stored in the session::<id> history and event log,
+# one of 'json', 'msgpack' or 'cbor' (needs cbor2)
+SESSION_EVENT_STORAGE_FORMAT = 'msgpack'
+
+# "Latest value wins" player events that are merged per session, only the
+# latest event inside the window (in seconds) is stored and sent to clients
+SESSION_COALESCED_EVENTS = {
+    'progress': 0.5,
+    'volume': 0.25,
+}
+
+# Access tokens resolved by a process are trusted for this many seconds (at most
+# ACCESS_TOKEN_LOCAL_SIZE of them), the snapshot in Redis for ACCESS_TOKEN_SNAPSHOT_TTL.
+# Deleted tokens are evicted everywhere right away
+ACCESS_TOKEN_LOCAL_TTL = 30
+ACCESS_TOKEN_LOCAL_SIZE = 10000
+ACCESS_TOKEN_SNAPSHOT_TTL = 60 * 10
+
+# Access tokens expire this long after login, a user keeps at most
+# ACCESS_TOKENS_PER_USER of them (the oldest ones are deleted on login)
+ACCESS_TOKEN_LIFETIME = datetime.timedelta(days=30)
+ACCESS_TOKENS_PER_USER = 10
+
+# Websocket events that only the owner of a session can send, unless the
+# SessionSettings permission they map to is enabled
+SESSION_EVENT_PERMISSIONS = {
+    'play': 'anyone_can_use_player_controls',
+    'pause': 'anyone_can_use_player_controls',
+    'skip': 'anyone_can_use_player_controls',
+    'previous': 'anyone_can_use_player_controls',
+    'seek': 'anyone_can_use_player_controls',
+    'volume': 'anyone_can_use_player_controls',
+    'queue_add': 'anyone_can_add_to_queue',
+    'queue_remove': 'anyone_can_remove_from_queue',
+}
+
 ROOT_URLCONF = 'tawa3.urls'
\ No newline at end of file
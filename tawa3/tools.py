@@ -1,4 +1,7 @@
 import json
+import uuid
+
+from tawa3.serializers import serialize
 
 
 def is_authenticated(request):
@@ -16,9 +19,17 @@ def to_json_small(obj):
   return obj.toJSON(recursive=False)
 
 
-def J(obj):
-  return obj.toJSON()
+def J(obj, fields=None):
+  return serialize(obj, fields=fields)
+
+
+def JS(obj, fields=None):
+  return serialize(obj, recursive=False, fields=fields)
 
 
-def JS(obj):
-  return obj.toJSON(recursive=False)
\ No newline at end of file
+def new_version():
+  """
+    A value for a version key in Redis that workers compare with the version they cached.
+    Unlike a counter it cannot come back to a value a worker already saw when Redis loses its data
+  """
+  return uuid.uuid4().hex
\ No newline at end of file
@@ -28,6 +28,7 @@ urlpatterns = [
     # user
     path('user/', include('user.urls')),
     # playlist
+    path('playlist/', include('playlist.urls')),
     path(r'rpc/', RPCEntryPoint.as_view(enable_doc=True, protocol=JSONRPC_PROTOCOL)),
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from user.reaper import reap_access_tokens
+
+
+class Command(BaseCommand):
+  help = 'Deletes expired access tokens'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=1000, help='Number of tokens deleted per statement')
+    parser.add_argument('--interval', type=float, default=None, help='Keep reaping every this many seconds instead of reaping once')
+
+  def handle(self, *args, **options):
+    interval = options['interval']
+
+    while True:
+      removed = reap_access_tokens(options['batch_size'])
+
+      if removed > 0 or interval is None:
+        self.stdout.write(f'Removed {removed} access tokens')
+
+      if interval is None:
+        break
+
+      time.sleep(interval)
@@ -0,0 +1,51 @@
+# Generated by Django 4.1.4 on 2026-10-18 09:10
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def backfill_token_digests(apps, schema_editor):
+    AccessToken = apps.get_model('user', 'AccessToken')
+
+    seen = set()
+    tokens, duplicates = [], []
+
+    for access_token in AccessToken.objects.only('id', 'token').order_by('-id').iterator(chunk_size=2000):
+        access_token.token_digest = hashlib.sha256(access_token.token.encode()).hexdigest()
+
+        # The same token can only be used once, the newest row is kept
+        if access_token.token_digest in seen:
+            duplicates.append(access_token.id)
+            continue
+
+        seen.add(access_token.token_digest)
+        tokens.append(access_token)
+
+        if len(tokens) == 2000:
+            AccessToken.objects.bulk_update(tokens, ['token_digest'])
+            tokens = []
+
+    AccessToken.objects.bulk_update(tokens, ['token_digest'])
+    AccessToken.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0005_remove_accesstoken_last_used_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesstoken',
+            name='token_digest',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_token_digests, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='token_digest',
+            field=models.CharField(editable=False, max_length=64, unique=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.1.4 on 2026-10-18 09:20
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+import user.models
+
+
+def backfill_expiry(apps, schema_editor):
+    AccessToken = apps.get_model('user', 'AccessToken')
+
+    lifetime = getattr(settings, 'ACCESS_TOKEN_LIFETIME', datetime.timedelta(days=30))
+    AccessToken.objects.update(expires_at=F('created_at') + lifetime)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0006_accesstoken_token_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesstoken',
+            name='expires_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(backfill_expiry, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, default=user.models.token_expiry),
+        ),
+    ]
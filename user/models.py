@@ -1,8 +1,14 @@
+import hashlib
 import json
+import datetime
 
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 
+from tawa3.serializers import register
+
 
 class User(AbstractUser):
   profile_picture = models.ImageField(upload_to='profile_pictures', blank=True, null=True)
@@ -18,10 +24,29 @@ class User(AbstractUser):
     return self.username
 
 
+def hash_token(token):
+  return hashlib.sha256(token.encode()).hexdigest()
+
+
+def token_expiry():
+  return timezone.now() + getattr(settings, 'ACCESS_TOKEN_LIFETIME', datetime.timedelta(days=30))
+
+
 class AccessToken(models.Model):
   user = models.ForeignKey(User, on_delete=models.CASCADE)
   token = models.CharField(max_length=255)
+  # Tokens are looked up by their hash, it is set from the token on save
+  token_digest = models.CharField(max_length=64, unique=True, editable=False)
   created_at = models.DateTimeField(auto_now_add=True)
+  expires_at = models.DateTimeField(default=token_expiry, db_index=True)
+
+  @property
+  def is_expired(self):
+    return self.expires_at <= timezone.now()
+
+  def save(self, *args, **kwargs):
+    self.token_digest = hash_token(self.token)
+    super().save(*args, **kwargs)
 
   def toJSON(self, recursive=True):
     return {
@@ -32,4 +57,7 @@ class AccessToken(models.Model):
     }
 
   def __str__(self):
-    return f'{self.user.username} - {self.token}'
\ No newline at end of file
+    return f'{self.user.username} - {self.token}'
+
+
+register(AccessToken, select_related=['user'])
@@ -0,0 +1,22 @@
+from django.utils import timezone
+
+from user.models import AccessToken
+
+
+def reap_access_tokens(batch_size=1000):
+  """
+    Deletes expired access tokens in batches of `batch_size`, every batch is its own short
+    DELETE by primary key, found with the expires_at index. Returns the number of deleted tokens
+  """
+  now = timezone.now()
+  removed = 0
+
+  while True:
+    ids = list(AccessToken.objects.filter(expires_at__lte=now).order_by('expires_at').values_list('id', flat=True)[:batch_size])
+
+    if len(ids) == 0:
+      break
+
+    removed += AccessToken.objects.filter(id__in=ids).delete()[0]
+
+  return removed
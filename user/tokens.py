@@ -0,0 +1,267 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from user.models import User, AccessToken, hash_token
+
+redis = get_redis_connection('default')
+
+
+# Seconds a resolved token is trusted by a process without asking Redis
+LOCAL_TTL = getattr(settings, 'ACCESS_TOKEN_LOCAL_TTL', 30)
+
+# Tokens a process keeps, the least recently used one is dropped first
+LOCAL_SIZE = getattr(settings, 'ACCESS_TOKEN_LOCAL_SIZE', 10000)
+
+# Seconds a snapshot stays in Redis, the database is asked again after that
+SNAPSHOT_TTL = getattr(settings, 'ACCESS_TOKEN_SNAPSHOT_TTL', 60 * 10)
+
+# Every process evicts the digests published here from its local cache
+REVOKED_CHANNEL = 'access_tokens::revoked'
+
+# Stored instead of a snapshot when a token is deleted, so a request that read the token
+# from the database before it was deleted cannot cache it again
+REVOKED = b'revoked'
+
+# Not part of the snapshot, the instances load it from the database if it is ever needed
+EXCLUDED_USER_FIELDS = {'password'}
+
+
+def snapshot_key(digest):
+  return f'access_token::{digest}'
+
+
+def user_tokens_key(user_id):
+  return f'user::{user_id}::access_tokens'
+
+
+def snapshot_fields(model, exclude=()):
+  return [field for field in model._meta.concrete_fields if field.name not in exclude]
+
+
+def dump_instance(instance, fields):
+  return {field.attname: field.get_prep_value(field.value_from_object(instance)) for field in fields}
+
+
+def load_instance(model, fields, data):
+  """
+    Builds an instance like one loaded from the database, fields that are not in the
+    snapshot are deferred
+  """
+  return model.from_db('default', [field.attname for field in fields], [field.to_python(data[field.attname]) for field in fields])
+
+
+USER_FIELDS = snapshot_fields(User, EXCLUDED_USER_FIELDS)
+TOKEN_FIELDS = snapshot_fields(AccessToken)
+
+
+def dump_snapshot(access_token):
+  return json.dumps({
+    'user': dump_instance(access_token.user, USER_FIELDS),
+    'token': dump_instance(access_token, TOKEN_FIELDS),
+  }, cls=DjangoJSONEncoder)
+
+
+def load_snapshot(snapshot):
+  data = json.loads(snapshot)
+
+  access_token = load_instance(AccessToken, TOKEN_FIELDS, data['token'])
+  access_token.user = load_instance(User, USER_FIELDS, data['user'])
+
+  return access_token
+
+
+class LocalTokenCache:
+  """
+    A bounded LRU of digest -> AccessToken (with its user) whose entries expire after `ttl` seconds
+  """
+
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, digest):
+    with self.lock:
+      entry = self.entries.get(digest)
+
+      if entry is None:
+        return None
+
+      expires, access_token = entry
+
+      if expires < time.monotonic():
+        del self.entries[digest]
+        return None
+
+      self.entries.move_to_end(digest)
+      return access_token
+
+  def set(self, digest, access_token):
+    with self.lock:
+      self.entries[digest] = (time.monotonic() + self.ttl, access_token)
+      self.entries.move_to_end(digest)
+
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+  def evict(self, digests):
+    with self.lock:
+      for digest in digests:
+        self.entries.pop(digest, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+local_cache = LocalTokenCache(LOCAL_SIZE, LOCAL_TTL)
+
+
+class RevocationListener:
+  """
+    Evicts the tokens that were revoked by any process from the local cache. Runs in a
+    daemon thread that is started with the first resolved token
+  """
+
+  def __init__(self, cache):
+    self.cache = cache
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def ensure_running(self):
+    if self.thread is not None and self.thread.is_alive():
+      return
+
+    with self.lock:
+      if self.thread is None or not self.thread.is_alive():
+        self.thread = threading.Thread(target=self.run, name='access-token-revocations', daemon=True)
+        self.thread.start()
+
+  def run(self):
+    while True:
+      try:
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(REVOKED_CHANNEL)
+
+        # Revocations that were published while not subscribed are lost
+        self.cache.clear()
+
+        for message in pubsub.listen():
+          self.cache.evict(message['data'].decode().split(','))
+      except Exception:
+        self.cache.clear()
+        time.sleep(1)
+
+
+revocation_listener = RevocationListener(local_cache)
+
+
+def cached_token(token):
+  """
+    Returns the AccessToken of a token string if this process has it cached, without
+    any I/O, so async code can skip the thread hop of resolve_token for hot tokens
+  """
+  access_token = local_cache.get(hash_token(token))
+
+  return None if access_token is None or access_token.is_expired else access_token
+
+
+def resolve_token(token):
+  """
+    Returns the AccessToken (with its user loaded) of a token string or None. Asks the
+    local cache first, then the snapshot in Redis and only then the database
+  """
+  digest = hash_token(token)
+
+  revocation_listener.ensure_running()
+
+  access_token = local_cache.get(digest)
+
+  if access_token is not None:
+    return None if access_token.is_expired else access_token
+
+  snapshot = redis.get(snapshot_key(digest))
+
+  if snapshot == REVOKED:
+    return None
+
+  if snapshot is not None:
+    access_token = load_snapshot(snapshot)
+  else:
+    access_token = AccessToken.objects.select_related('user').filter(token_digest=digest).first()
+
+    if access_token is None or access_token.is_expired:
+      return None
+
+    # The snapshot does not outlive the token
+    ttl = min(SNAPSHOT_TTL, max(1, int((access_token.expires_at - timezone.now()).total_seconds())))
+
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.set(snapshot_key(digest), dump_snapshot(access_token), ex=ttl, nx=True)
+    pipeline.get(snapshot_key(digest))
+    pipeline.sadd(user_tokens_key(access_token.user_id), digest)
+    pipeline.expire(user_tokens_key(access_token.user_id), SNAPSHOT_TTL)
+    _, snapshot, _, _ = pipeline.execute()
+
+    if snapshot == REVOKED:
+      return None
+
+  if access_token.is_expired:
+    return None
+
+  local_cache.set(digest, access_token)
+
+  return access_token
+
+
+def evict_digests(digests, revoked=False):
+  """
+    Drops the snapshots of the digests and tells every process to forget them. Revoked
+    digests are remembered, so they are not cached again while a snapshot could exist
+  """
+  digests = list(digests)
+
+  if len(digests) == 0:
+    return
+
+  local_cache.evict(digests)
+
+  pipeline = redis.pipeline(transaction=False)
+
+  for digest in digests:
+    if revoked:
+      pipeline.set(snapshot_key(digest), REVOKED, ex=SNAPSHOT_TTL)
+    else:
+      pipeline.delete(snapshot_key(digest))
+
+  pipeline.publish(REVOKED_CHANNEL, ','.join(digests))
+  pipeline.execute()
+
+
+@receiver(post_delete, sender=AccessToken)
+def access_token_deleted(sender, instance, **kwargs):
+  # Expired tokens are rejected anyway and their snapshots expire with them
+  if instance.is_expired:
+    return
+
+  digest = instance.token_digest
+
+  redis.srem(user_tokens_key(instance.user_id), digest)
+  evict_digests([digest], revoked=True)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+  # The snapshots of the tokens of the user are outdated
+  if not created:
+    evict_digests(digest.decode() for digest in redis.smembers(user_tokens_key(instance.id)))
@@ -1,5 +1,7 @@
 import secrets
 
+from django.conf import settings
+
 from modernrpc.core import rpc_method
 from modernrpc.auth import set_authentication_predicate
 from django.contrib.auth import authenticate
@@ -7,6 +9,10 @@ from tawa3.tools import is_authenticated
 
 from user.models import User, AccessToken
 
+# Active access tokens per user, see login
+TOKENS_PER_USER = getattr(settings, 'ACCESS_TOKENS_PER_USER', 10)
+
+
 @rpc_method
 def register(email, username, password, **kwargs):
   try:
@@ -33,6 +39,12 @@ def login(username, password, **kwargs):
     token = secrets.token_urlsafe(64).replace('-', '_')
     access_token = AccessToken.objects.create(user=user, token=token)
 
+    # Only the newest tokens of a user stay valid
+    token_ids = list(AccessToken.objects.filter(user=user).order_by('-created_at', '-id').values_list('id', flat=True))
+
+    if len(token_ids) > TOKENS_PER_USER:
+      AccessToken.objects.filter(id__in=token_ids[TOKENS_PER_USER:]).delete()
+
     return {
       'token': access_token.token,
       'user': user.toJSON()